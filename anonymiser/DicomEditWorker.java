@@ -0,0 +1,243 @@
+// Author: Jason Lunn, The Institute of Cancer Research, UK
+
+// Long-lived worker used by anonymiser.py to run many DicomEdit jobs inside one JVM, and etherj 'rtsedit' jobs as
+// well when given the etherj-cli-tools lib folder (batch_rtsedit.py)
+// Run with a Java 11+ runtime as a single-file program, no separate compile step is needed;
+//     java DicomEditWorker.java <dicom-edit.jar> [<etherj-cli-tools lib folder>]
+//
+// Requests are read from stdin and responses written to stdout, all values big-endian;
+//     request:  tool name, argument count (int), arguments
+//     response: exit status (int), captured stdout, captured stderr
+// where every string is sent as a byte length (int) followed by its UTF-8 bytes
+//
+// System.out and System.err are replaced once, before either tool is loaded, and only the buffer behind them changes
+// from job to job, so a logger that keeps hold of the stream it found when its class was loaded still writes into the
+// current job's output. Anything written between jobs goes to the worker's own stderr.
+// System.exit inside a job is turned into that job's exit status where the runtime still allows a SecurityManager
+// (Java 11 to 17). On later runtimes the call ends the worker, anonymiser.py reports the job as failed and starts a
+// new worker for the next one.
+
+import java.io.BufferedInputStream;
+import java.io.BufferedOutputStream;
+import java.io.ByteArrayOutputStream;
+import java.io.DataInputStream;
+import java.io.DataOutputStream;
+import java.io.EOFException;
+import java.io.File;
+import java.io.FileDescriptor;
+import java.io.FileOutputStream;
+import java.io.IOException;
+import java.io.OutputStream;
+import java.io.PrintStream;
+import java.lang.reflect.InvocationTargetException;
+import java.lang.reflect.Method;
+import java.net.URL;
+import java.net.URLClassLoader;
+import java.nio.charset.StandardCharsets;
+import java.security.Permission;
+import java.util.ArrayList;
+import java.util.List;
+import java.util.jar.JarFile;
+
+public class DicomEditWorker {
+    private static final String RTSEDIT_CLASS = "icr.etherj.clients.RtsEdit";
+    // jars holding the rtsedit client itself, loaded fresh for every job so no static state leaks between files
+    private static final String[] RTSEDIT_CLIENT_JARS = {"rtsedit.jar", "common.jar"};
+
+    private final Method dicomEditMain;
+    // left null when no etherj lib folder is given, rtsedit jobs then fail
+    private ClassLoader etherjLoader;
+    private URL[] rtsEditClientUrls;
+
+    private DicomEditWorker(File dicomEditJar, File libFolder) throws Exception {
+        String dicomEditClass;
+        try (JarFile jarFile = new JarFile(dicomEditJar)) {
+            dicomEditClass = jarFile.getManifest().getMainAttributes().getValue("Main-Class");
+        }
+        ClassLoader dicomEditLoader = new URLClassLoader(new URL[]{dicomEditJar.toURI().toURL()},
+                ClassLoader.getPlatformClassLoader());
+        dicomEditMain = dicomEditLoader.loadClass(dicomEditClass).getMethod("main", String[].class);
+
+        if (libFolder == null) {
+            return;
+        }
+        List<URL> libraryUrls = new ArrayList<>();
+        List<URL> clientUrls = new ArrayList<>();
+        File[] jars = libFolder.listFiles((folder, name) -> name.endsWith(".jar"));
+        if (jars == null) {
+            throw new IOException("etherj library folder not found: " + libFolder);
+        }
+        for (File jar : jars) {
+            if (isRtsEditClientJar(jar.getName())) {
+                clientUrls.add(jar.toURI().toURL());
+            } else {
+                libraryUrls.add(jar.toURI().toURL());
+            }
+        }
+        etherjLoader = new URLClassLoader(libraryUrls.toArray(new URL[0]), ClassLoader.getPlatformClassLoader());
+        rtsEditClientUrls = clientUrls.toArray(new URL[0]);
+    }
+
+    private static boolean isRtsEditClientJar(String name) {
+        for (String clientJar : RTSEDIT_CLIENT_JARS) {
+            if (clientJar.equals(name)) {
+                return true;
+            }
+        }
+        return false;
+    }
+
+    private Method rtsEditMain() throws Exception {
+        ClassLoader clientLoader = new URLClassLoader(rtsEditClientUrls, etherjLoader);
+        return clientLoader.loadClass(RTSEDIT_CLASS).getMethod("main", String[].class);
+    }
+
+    private int runJob(String tool, String[] jobArgs) {
+        try {
+            Method toolMain;
+            if ("rtsedit".equals(tool) && etherjLoader != null) {
+                toolMain = rtsEditMain();
+            } else if ("dicomedit".equals(tool)) {
+                toolMain = dicomEditMain;
+            } else {
+                System.err.println("Unknown or unavailable tool requested: " + tool);
+                return 2;
+            }
+            toolMain.invoke(null, (Object) jobArgs);
+            return 0;
+        } catch (InvocationTargetException e) {
+            if (e.getCause() instanceof JobExitException) {
+                return ((JobExitException) e.getCause()).status;
+            }
+            e.getCause().printStackTrace();
+            return 1;
+        } catch (Exception e) {
+            e.printStackTrace();
+            return 1;
+        }
+    }
+
+    private static class JobExitException extends SecurityException {
+        private final int status;
+
+        private JobExitException(int status) {
+            super("System.exit(" + status + ") called by the job");
+            this.status = status;
+        }
+    }
+
+    @SuppressWarnings("removal")
+    private static void trapExit() {
+        try {
+            System.setSecurityManager(new SecurityManager() {
+                @Override
+                public void checkExit(int status) {
+                    throw new JobExitException(status);
+                }
+
+                @Override
+                public void checkPermission(Permission permission) {
+                }
+
+                @Override
+                public void checkPermission(Permission permission, Object context) {
+                }
+            });
+        } catch (UnsupportedOperationException e) {
+            // Java 18 and later refuse a SecurityManager by default, System.exit then ends the worker
+        }
+    }
+
+    // output stream that writes to the current job's buffer, or to idleTarget when no job is running
+    private static class JobStream extends OutputStream {
+        private final OutputStream idleTarget;
+        private ByteArrayOutputStream jobTarget;
+
+        private JobStream(OutputStream idleTarget) {
+            this.idleTarget = idleTarget;
+        }
+
+        private synchronized void startJob() {
+            jobTarget = new ByteArrayOutputStream();
+        }
+
+        private synchronized String finishJob() {
+            String jobOutput = new String(jobTarget.toByteArray(), StandardCharsets.UTF_8);
+            jobTarget = null;
+            return jobOutput;
+        }
+
+        private OutputStream target() {
+            return jobTarget != null ? jobTarget : idleTarget;
+        }
+
+        @Override
+        public synchronized void write(int b) throws IOException {
+            target().write(b);
+        }
+
+        @Override
+        public synchronized void write(byte[] b, int off, int len) throws IOException {
+            target().write(b, off, len);
+        }
+
+        @Override
+        public synchronized void flush() throws IOException {
+            target().flush();
+        }
+    }
+
+    private static String readString(DataInputStream input) throws IOException {
+        byte[] bytes = new byte[input.readInt()];
+        input.readFully(bytes);
+        return new String(bytes, StandardCharsets.UTF_8);
+    }
+
+    private static void writeString(DataOutputStream output, String value) throws IOException {
+        byte[] bytes = value.getBytes(StandardCharsets.UTF_8);
+        output.writeInt(bytes.length);
+        output.write(bytes);
+    }
+
+    public static void main(String[] args) throws Exception {
+        // the tools print to System.out and System.err, so responses go straight to the stdout file descriptor
+        DataInputStream requests = new DataInputStream(new BufferedInputStream(System.in));
+        DataOutputStream responses = new DataOutputStream(
+                new BufferedOutputStream(new FileOutputStream(FileDescriptor.out)));
+        JobStream jobOut = new JobStream(new FileOutputStream(FileDescriptor.err));
+        JobStream jobErr = new JobStream(new FileOutputStream(FileDescriptor.err));
+        System.setOut(new PrintStream(jobOut, true, "UTF-8"));
+        System.setErr(new PrintStream(jobErr, true, "UTF-8"));
+        trapExit();
+
+        DicomEditWorker worker = new DicomEditWorker(new File(args[0]), args.length > 1 ? new File(args[1]) : null);
+
+        while (true) {
+            String tool;
+            try {
+                tool = readString(requests);
+            } catch (EOFException e) {
+                break;
+            }
+            String[] jobArgs = new String[requests.readInt()];
+            for (int i = 0; i < jobArgs.length; i++) {
+                jobArgs[i] = readString(requests);
+            }
+
+            jobOut.startJob();
+            jobErr.startJob();
+            int status;
+            try {
+                status = worker.runJob(tool, jobArgs);
+            } finally {
+                System.out.flush();
+                System.err.flush();
+            }
+
+            responses.writeInt(status);
+            writeString(responses, jobOut.finishJob());
+            writeString(responses, jobErr.finishJob());
+            responses.flush();
+        }
+    }
+}
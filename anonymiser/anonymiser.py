@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+
+# Author: Jason Lunn, The Institute of Cancer Research, UK
+
+# Batch anonymisation service, running many DicomEdit jobs through long-lived JVMs rather than one
+# 'java -jar dicom-edit.jar' per file, or in-process with das_interpreter when the script allows it
+import re
+import os
+import queue
+import shutil
+import struct
+import hashlib
+import pathlib
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from anonymiser import das_interpreter
+
+WORKER_SOURCE_PATH = pathlib.Path(__file__).parent.absolute() / "DicomEditWorker.java"
+# jobs handed to each interpreter process at a time
+INTERPRETER_CHUNK_SIZE = 16
+
+
+class DicomEditWorker:
+    # one JVM (DicomEditWorker.java) with dicom-edit.jar loaded, fed jobs over a pipe
+    # given the etherj-cli-tools lib folder as lib_path it runs etherj 'rtsedit' jobs as well, see batch_rtsedit.py
+    def __init__(self, jar_path, lib_path=None, worker_source_path=WORKER_SOURCE_PATH):
+        self.command = ["java", str(worker_source_path), str(jar_path)]
+        if lib_path is not None:
+            self.command.append(str(lib_path))
+        self.process = None
+
+        self.start()
+
+    def start(self):
+        # stderr is inherited, the worker writes its start up failures and anything printed between jobs there
+        self.process = subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def write_string(self, value):
+        encoded = value.encode('utf-8')
+        self.process.stdin.write(struct.pack('>i', len(encoded)))
+        self.process.stdin.write(encoded)
+
+    def read_exact(self, length):
+        data = self.process.stdout.read(length)
+        if len(data) != length:
+            raise EOFError("DicomEdit worker exited unexpectedly")
+        return data
+
+    def read_string(self):
+        (length,) = struct.unpack('>i', self.read_exact(4))
+        return self.read_exact(length).decode('utf-8')
+
+    def run(self, dicom_edit_args):
+        return self.run_tool("dicomedit", dicom_edit_args)
+
+    def run_tool(self, tool, tool_args):
+        if self.process.poll() is not None:
+            # the worker ended between jobs, e.g. a thread left running by the last job called System.exit
+            self.start()
+
+        try:
+            self.write_string(tool)
+            self.process.stdin.write(struct.pack('>i', len(tool_args)))
+            for tool_arg in tool_args:
+                self.write_string(str(tool_arg))
+            self.process.stdin.flush()
+
+            (status,) = struct.unpack('>i', self.read_exact(4))
+            job_output = self.read_string()
+            job_error = self.read_string()
+        except (EOFError, BrokenPipeError) as e:
+            # a tool calling System.exit takes the worker down with it, so report the job and start afresh
+            self.close()
+            self.start()
+            return 1, "", f"Exception: {tool} worker error; {e}"
+
+        return status, job_output, job_error
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.process.wait()
+
+
+class AnonymisationResult:
+    def __init__(self, input_path, output_path, variables, status, error):
+        self.input_path = input_path
+        self.output_path = output_path
+        self.variables = variables
+        self.status = status
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def as_dict(self):
+        return {"input_path": str(self.input_path),
+                "output_path": str(self.output_path),
+                "variables": self.variables,
+                "status": self.status,
+                "error": self.error}
+
+
+def find_jar_error(status, jar_error):
+    # DicomEdit reports most problems on stderr without failing, so this is the same check the scripts used
+    if re.search(r"\b" + re.escape('error') + r"\b", jar_error, flags=re.IGNORECASE):
+        return jar_error.strip()
+    if status != 0:
+        return jar_error.strip() or f"DicomEdit exited with status {status}"
+
+    return None
+
+
+def interpret_job(profile, input_path, output_path):
+    # returns (status, error), or None when the file needs something the interpreter can't do
+    try:
+        das_interpreter.apply_profile_file(profile, input_path, output_path)
+    except das_interpreter.UnsupportedDasConstruct:
+        return None
+    except Exception as e:
+        return 1, f"{type(e).__name__}: {e}"
+
+    return 0, None
+
+
+class AnonymisationService:
+    # script_path is the base anonymisation profile and script_additions a function taking a job's variables as
+    # keyword arguments and returning the lines to append for it, e.g. the anonymised patient name
+    # workers is the number of DicomEdit JVMs and processes the number of cores used for interpreted jobs
+    def __init__(self, script_path, script_additions, jar_path="dicom-edit.jar", workers=1, processes=None,
+                 use_interpreter=True):
+        self.script_path = script_path
+        self.script_additions = script_additions
+        self.jar_path = jar_path
+        self.workers = workers
+        self.processes = processes or os.cpu_count()
+        self.use_interpreter = use_interpreter
+
+        with open(script_path, 'r') as standard_script:
+            self.script_content = standard_script.read()
+
+        # DicomEdit only takes its script as a file, so each distinct set of variables is written out once,
+        # privately to this service, rather than rewriting a shared customised_script.das for every file
+        self.script_folder = tempfile.mkdtemp(prefix="anonymisation_scripts_")
+        self.scripts = {}
+        # compiled scripts, or None for those that have to go to DicomEdit
+        self.profiles = {}
+        self.scripts_lock = threading.Lock()
+
+        self.idle_workers = queue.Queue()
+        self.all_workers = []
+        self.workers_lock = threading.Lock()
+        # processes for interpreted jobs, started with the first batch that needs them and kept until close()
+        self.interpreter_pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def script_text(self, variables):
+        return self.script_content + self.script_additions(**variables)
+
+    def script_for(self, variables):
+        script_key = tuple(sorted(variables.items()))
+
+        with self.scripts_lock:
+            custom_script_path = self.scripts.get(script_key)
+            if custom_script_path is None:
+                script_hash = hashlib.sha1(repr(script_key).encode('utf-8')).hexdigest()
+                custom_script_path = os.path.join(self.script_folder, f"{script_hash}.das")
+                with open(custom_script_path, 'w') as custom_script:
+                    custom_script.write(self.script_text(variables))
+                self.scripts[script_key] = custom_script_path
+
+        return custom_script_path
+
+    def profile_for(self, variables):
+        if not self.use_interpreter:
+            return None
+
+        script_key = tuple(sorted(variables.items()))
+
+        with self.scripts_lock:
+            if script_key not in self.profiles:
+                try:
+                    self.profiles[script_key] = das_interpreter.compile_das(self.script_text(variables))
+                except das_interpreter.UnsupportedDasConstruct:
+                    self.profiles[script_key] = None
+
+            return self.profiles[script_key]
+
+    def acquire_worker(self):
+        try:
+            return self.idle_workers.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self.workers_lock:
+            if len(self.all_workers) < self.workers:
+                worker = DicomEditWorker(self.jar_path)
+                self.all_workers.append(worker)
+                return worker
+
+        return self.idle_workers.get()
+
+    def acquire_interpreter_pool(self):
+        with self.workers_lock:
+            if self.interpreter_pool is None:
+                self.interpreter_pool = ProcessPoolExecutor(max_workers=self.processes)
+
+            return self.interpreter_pool
+
+    def anonymise(self, input_path, output_path, variables):
+        profile = self.profile_for(variables)
+        if profile is not None:
+            outcome = interpret_job(profile, input_path, output_path)
+            if outcome is not None:
+                return AnonymisationResult(input_path, output_path, variables, *outcome)
+
+        return self.run_dicom_edit(input_path, output_path, variables)
+
+    def run_dicom_edit(self, input_path, output_path, variables):
+        custom_script_path = self.script_for(variables)
+
+        worker = self.acquire_worker()
+        try:
+            status, jar_output, jar_error = worker.run(["-s", custom_script_path, "-i", str(input_path),
+                                                        "-o", str(output_path)])
+        finally:
+            self.idle_workers.put(worker)
+
+        return AnonymisationResult(input_path, output_path, variables, status, find_jar_error(status, jar_error))
+
+    def anonymise_batch(self, jobs):
+        # jobs is an iterable of (input path, output path, variables dict), results come back in the same order
+        jobs = list(jobs)
+        results = [None] * len(jobs)
+
+        # interpreted across all cores first, anything left over then goes through the DicomEdit JVMs
+        interpreted_jobs = [(index, job, self.profile_for(job[2])) for index, job in enumerate(jobs)]
+        interpreted_jobs = [(index, job, profile) for index, job, profile in interpreted_jobs if profile is not None]
+        if interpreted_jobs:
+            outcomes = self.acquire_interpreter_pool().map(interpret_job,
+                                                           [profile for index, job, profile in interpreted_jobs],
+                                                           [job[0] for index, job, profile in interpreted_jobs],
+                                                           [job[1] for index, job, profile in interpreted_jobs],
+                                                           chunksize=INTERPRETER_CHUNK_SIZE)
+            for (index, job, profile), outcome in zip(interpreted_jobs, outcomes):
+                if outcome is not None:
+                    results[index] = AnonymisationResult(*job, *outcome)
+
+        dicom_edit_indexes = [index for index, result in enumerate(results) if result is None]
+        if dicom_edit_indexes:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                dicom_edit_results = pool.map(lambda index: self.run_dicom_edit(*jobs[index]), dicom_edit_indexes)
+                for index, result in zip(dicom_edit_indexes, dicom_edit_results):
+                    results[index] = result
+
+        return results
+
+    def close(self):
+        with self.workers_lock:
+            for worker in self.all_workers:
+                worker.close()
+            self.all_workers = []
+            self.idle_workers = queue.Queue()
+
+            if self.interpreter_pool is not None:
+                self.interpreter_pool.shutdown()
+                self.interpreter_pool = None
+
+        shutil.rmtree(self.script_folder, ignore_errors=True)
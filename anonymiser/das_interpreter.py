@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+# Author: Jason Lunn, The Institute of Cancer Research, UK
+
+# In-process interpreter for the DicomEdit 6 subset written by build_dicom_profile.py, compiling a .das script into
+# an action table that is applied to each dataset with pydicom in a single pass over its elements
+#
+# Supported statements;
+#     version "6.1"
+#     (gggg,eeee) := "value"       assign, creating the attribute if it is missing
+#     - (gggg,eeee)                remove
+#     removeAllPrivateTags
+# where a tag may use x for a wildcard digit, e.g. (50xx,xxxx), and anything else raises UnsupportedDasConstruct so
+# the script can be run by DicomEdit itself, including sequence item assignments such as (gggg,eeee)[*] := "value"
+import re
+
+import pydicom
+from pydicom.datadict import dictionary_VR
+from pydicom.errors import InvalidDicomError
+
+import build_dicom_profile
+
+ASSIGN = "assign"
+REMOVE = "remove"
+
+# VRs that are not stored as text, so can only be assigned an empty value
+BINARY_VRS = {'AT', 'FL', 'FD', 'OB', 'OD', 'OF', 'OL', 'OV', 'OW', 'SL', 'SS', 'SV', 'UL', 'US', 'UV', 'UN'}
+
+TAG_TEXT = r'\([0-9A-Fa-fxX]{4},[0-9A-Fa-fxX]{4}\)'
+VERSION_STATEMENT = re.compile(r'^version\s+"[^"]*"$')
+ASSIGNMENT_STATEMENT = re.compile(rf'^(?P<tag>{TAG_TEXT})(?P<items>\[\*\])?\s*:=\s*"(?P<value>(?:[^"\\]|\\.)*)"$')
+REMOVAL_STATEMENT = re.compile(rf'^-\s*(?P<tag>{TAG_TEXT})$')
+REMOVE_PRIVATE_STATEMENT = "removeAllPrivateTags"
+
+
+class UnsupportedDasConstruct(Exception):
+    pass
+
+
+def strip_comment(line):
+    # drops a trailing // comment, ignoring any // inside a quoted value
+    in_quotes = False
+    escaped = False
+    for position, character in enumerate(line):
+        if escaped:
+            escaped = False
+        elif character == '\\':
+            escaped = True
+        elif character == '"':
+            in_quotes = not in_quotes
+        elif not in_quotes and line.startswith('//', position):
+            return line[:position]
+
+    return line
+
+
+def unescape_value(value):
+    return re.sub(r'\\(.)', r'\1', value)
+
+
+def parse_tag(tag_text):
+    # returns (mask, tag) where the mask is zero for the wildcard digits
+    digits = tag_text[1:5] + tag_text[6:10]
+    mask = 0
+    tag = 0
+    for digit in digits:
+        mask <<= 4
+        tag <<= 4
+        if digit not in 'xX':
+            mask |= 0xF
+            tag |= int(digit, 16)
+
+    return mask, tag
+
+
+class CompiledProfile:
+    def __init__(self):
+        # tag -> (statement number, action, value), the last statement for a tag wins as it would in DicomEdit
+        self.tag_actions = {}
+        # (mask, tag, statement number, action, value) for tags written with wildcards
+        self.wildcard_actions = []
+        self.remove_private_statement = None
+
+    def add_action(self, statement_number, tag_text, action, value=None):
+        mask, tag = parse_tag(tag_text)
+        if mask == 0xFFFFFFFF:
+            self.tag_actions[tag] = (statement_number, action, value)
+        else:
+            self.wildcard_actions.append((mask, tag, statement_number, action, value))
+
+    def action_for(self, tag):
+        chosen_action = self.tag_actions.get(tag)
+        for mask, wildcard_tag, statement_number, action, value in self.wildcard_actions:
+            if tag & mask == wildcard_tag and (chosen_action is None or statement_number > chosen_action[0]):
+                chosen_action = (statement_number, action, value)
+
+        return chosen_action
+
+    def apply(self, dataset):
+        for tag in list(dataset.keys()):
+            chosen_action = self.action_for(tag)
+
+            if tag.is_private and self.remove_private_statement is not None and \
+                    (chosen_action is None or chosen_action[0] < self.remove_private_statement):
+                del dataset[tag]
+                continue
+
+            if chosen_action is None:
+                continue
+
+            statement_number, action, value = chosen_action
+            if action == REMOVE:
+                del dataset[tag]
+            else:
+                assign_value(dataset[tag], value)
+
+        # exact assignments also create attributes that aren't there yet
+        for tag, (statement_number, action, value) in self.tag_actions.items():
+            if action == ASSIGN and tag not in dataset:
+                create_element(dataset, tag, value)
+
+        if self.remove_private_statement is not None:
+            for element in dataset:
+                if element.VR == 'SQ':
+                    for item in element.value:
+                        item.remove_private_tags()
+
+        return dataset
+
+
+def assign_value(element, value):
+    if element.VR == 'SQ':
+        raise UnsupportedDasConstruct(f"assigning a value to the sequence {element.tag}")
+
+    if element.VR in BINARY_VRS:
+        if value:
+            raise UnsupportedDasConstruct(f"assigning text to {element.tag} with VR {element.VR}")
+        element.value = None
+        return
+
+    try:
+        element.value = value
+    except (TypeError, ValueError) as e:
+        raise UnsupportedDasConstruct(f"assigning '{value}' to {element.tag}; {e}")
+
+
+def create_element(dataset, tag, value):
+    try:
+        vr = dictionary_VR(tag)
+    except KeyError:
+        raise UnsupportedDasConstruct(f"creating {tag:08X}, which is not in the DICOM dictionary")
+
+    if vr == 'SQ' or ' or ' in vr:
+        # ambiguous VRs such as 'US or SS' as well as sequences
+        raise UnsupportedDasConstruct(f"creating {tag:08X} with VR {vr}")
+
+    dataset.add_new(tag, vr, None)
+    assign_value(dataset[tag], value)
+
+
+def compile_das(script_text):
+    profile = CompiledProfile()
+
+    for statement_number, line in enumerate(script_text.splitlines()):
+        statement = strip_comment(line).strip()
+        if not statement or VERSION_STATEMENT.match(statement):
+            continue
+
+        if statement == REMOVE_PRIVATE_STATEMENT:
+            profile.remove_private_statement = statement_number
+            continue
+
+        assignment = ASSIGNMENT_STATEMENT.match(statement)
+        if assignment:
+            if assignment.group('items'):
+                # what DicomEdit does to the items of the sequence isn't reproduced here, so leave it to DicomEdit
+                raise UnsupportedDasConstruct(f"line {statement_number + 1}: {statement}")
+            profile.add_action(statement_number, assignment.group('tag'), ASSIGN,
+                               unescape_value(assignment.group('value')))
+            continue
+
+        removal = REMOVAL_STATEMENT.match(statement)
+        if removal:
+            profile.add_action(statement_number, removal.group('tag'), REMOVE)
+            continue
+
+        raise UnsupportedDasConstruct(f"line {statement_number + 1}: {statement}")
+
+    return profile
+
+
+def compile_das_file(script_path):
+    with open(script_path, 'r') as script_file:
+        return compile_das(script_file.read())
+
+
+def compile_profile_json(attribute_dict, profile_choices):
+    # builds the same statements build_dicom_profile would write out, without the round trip through a file
+    script_lines = build_dicom_profile.build_attribute_modifications(attribute_dict, profile_choices)
+    script_text = "".join(script_lines) + build_dicom_profile.create_profile_footer(profile_choices)
+
+    return compile_das(script_text)
+
+
+def apply_profile_file(profile, input_path, output_path):
+    try:
+        dataset = pydicom.read_file(input_path)
+    except InvalidDicomError:
+        # files without a preamble are left to DicomEdit rather than guessing at their encoding
+        raise UnsupportedDasConstruct(f"{input_path} is not a DICOM Part 10 file")
+    profile.apply(dataset)
+    dataset.save_as(output_path)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+# Author: Jason Lunn, The Institute of Cancer Research, UK
+
+# Parsed form of an XNAT 'services/dicomdump' result, indexed by tag once when loaded
+# Each dicomdump entry carries tag1, tag2, vr, value and desc, where tag2 is only set for elements nested inside
+# the sequence named by tag1
+
+
+class DicomDumpEntry:
+    __slots__ = ('tag1', 'tag2', 'vr', 'value', 'desc')
+
+    def __init__(self, tag1, tag2="", vr="", value="", desc=""):
+        self.tag1 = tag1
+        self.tag2 = tag2
+        self.vr = vr
+        self.value = value
+        self.desc = desc
+
+    @classmethod
+    def from_dict(cls, entry_dict):
+        return cls(entry_dict.get('tag1', ""), entry_dict.get('tag2', ""), entry_dict.get('vr', ""),
+                   entry_dict.get('value', ""), entry_dict.get('desc', ""))
+
+    def __getitem__(self, key):
+        # keeps the dict style access, e.g. entry['value'], used on the raw results
+        try:
+            return getattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+
+    def __repr__(self):
+        return f"DicomDumpEntry({self.tag1!r}, {self.tag2!r}, {self.vr!r}, {self.value!r})"
+
+
+def normalise_tag(tag_number):
+    # dicomdump writes tags as '(0020,000D)'
+    return tag_number.strip().upper() if tag_number else ""
+
+
+class DicomDump:
+    __slots__ = ('entries', 'tag1_index', 'tag2_index')
+
+    def __init__(self, dicomdump_results):
+        self.entries = [entry if isinstance(entry, DicomDumpEntry) else DicomDumpEntry.from_dict(entry)
+                        for entry in dicomdump_results or []]
+
+        # first entry for each tag1, which is what searching the list for a tag1 would find
+        self.tag1_index = {}
+        # tag1 -> tag2 -> first entry, for elements nested in a sequence
+        self.tag2_index = {}
+
+        for entry in self.entries:
+            tag1 = normalise_tag(entry.tag1)
+            self.tag1_index.setdefault(tag1, entry)
+            if entry.tag2:
+                self.tag2_index.setdefault(tag1, {}).setdefault(normalise_tag(entry.tag2), entry)
+
+    @classmethod
+    def from_json(cls, request_json):
+        return cls(request_json['ResultSet']['Result'])
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __bool__(self):
+        return bool(self.entries)
+
+    def __contains__(self, tag_number):
+        return self.get(tag_number) is not None
+
+    def get(self, tag1, tag2=None):
+        # tag1 can also be given as a (tag1, tag2) pair
+        if isinstance(tag1, tuple):
+            tag1, tag2 = tag1
+
+        if tag2:
+            return self.tag2_index.get(normalise_tag(tag1), {}).get(normalise_tag(tag2))
+
+        return self.tag1_index.get(normalise_tag(tag1))
+
+    def value(self, tag1, tag2=None, default=None):
+        entry = self.get(tag1, tag2)
+        if entry is None:
+            return default
+
+        return entry.value
+
+    def values(self, *tag_numbers, default=None):
+        # bulk lookup, one value per tag in the order asked for
+        return [self.value(tag_number, default=default) for tag_number in tag_numbers]
+
+    def nested(self, tag1):
+        # all the elements found inside the sequence tag1, keyed by tag2
+        return dict(self.tag2_index.get(normalise_tag(tag1), {}))
@@ -2,24 +2,21 @@
 
 # Author: Jason Lunn, The Institute of Cancer Research, UK
 
-import re
 import os
-import subprocess
+import csv
+import argparse
+import datetime
+from itertools import islice
 from tkinter.filedialog import askopenfilename
 
+import anonymiser.anonymiser as anonymiser
+import sop_classifier.sop_classifier as sop_classifier
 
-def find_files():
-    filepaths = []
-    for root, dirs, files in os.walk(rtss_folder):
-        for file in files:
-            if file.endswith(".dcm"):
-                filepaths.append(os.path.join(root, file))
+OUTPUT_FOLDER = "modified/fixed"
+CHECKPOINT_PATH = "modified/local_anon_checkpoint.txt"
 
-    print("Number of files found: ", len(filepaths))
-    return filepaths
 
-
-def anon_insertion(anon_name, script_path):
+def anon_insertion(anon_name):
     # (0010,0010) DICOM tag
     new_name = f"\n(0010,0010) := \"{anon_name}\" // Anonymised Patient Name\n"
     # (0010,0020) DICOM tag
@@ -34,50 +31,144 @@ def anon_insertion(anon_name, script_path):
     #                    f"AA:True\", session] // Patient Comments\n"
     # "(0008,0020), substring[(0008,0030), 0, 6], (0008,1090) // Patient Comments"
 
-    with open(script_path, 'r') as standard_script:
-        content = standard_script.read()
+    # appended to the anonymisation profile by the anonymisation service, once per subject
+    script_additions = new_name + new_id
+    # script_additions += project_line + session + study_desc + patient_comments
+
+    return script_additions
+
+
+def output_path_for(file_path):
+    return f"{OUTPUT_FOLDER}/{file_path[len(rtss_folder):].lstrip(os.sep)}"
+
+
+class Checkpoint:
+    # append-only record of the input files already anonymised, so an interrupted run carries on where it stopped
+    def __init__(self, checkpoint_path, script_path, restart=False):
+        self.checkpoint_path = checkpoint_path
+        # a checkpoint only applies to the same folder anonymised with the same profile
+        self.run_key = f"{os.path.abspath(rtss_folder)}\t{os.path.abspath(script_path)}"
+        self.completed = set()
+
+        if not restart and os.path.exists(checkpoint_path):
+            with open(checkpoint_path, 'r') as f:
+                if f.readline().rstrip("\n") == self.run_key:
+                    self.completed = {line.rstrip("\n") for line in f}
+
+        if self.completed:
+            self.checkpoint_file = open(checkpoint_path, 'a')
+        else:
+            self.checkpoint_file = open(checkpoint_path, 'w')
+            self.checkpoint_file.write(f"{self.run_key}\n")
+            self.checkpoint_file.flush()
+
+    def is_done(self, file_path):
+        return file_path in self.completed
+
+    def mark_done(self, file_paths):
+        self.checkpoint_file.writelines(f"{file_path}\n" for file_path in file_paths)
+        self.checkpoint_file.flush()
+        os.fsync(self.checkpoint_file.fileno())
 
-    custom_script_path = "customised_script.das"
-    with open(custom_script_path, 'w') as custom_script:
-        custom_script.write(content)
-        custom_script.write(new_name)
-        custom_script.write(new_id)
-        # custom_script.write(project_line)
-        # custom_script.write(session)
-        # # custom_script.write(study_desc)
-        # custom_script.write(patient_comments)
+    def close(self, finished):
+        self.checkpoint_file.close()
+        # nothing left to resume once every file has gone through
+        if finished:
+            os.remove(self.checkpoint_path)
 
-    return custom_script_path
 
+def anonymise_batch(anonymisation_service, batch):
+    # each output is written to a .partial file first and only renamed into place once anonymised
+    jobs = []
+    for file_path, anon_id in batch:
+        output_path = output_path_for(file_path)
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        jobs.append((file_path, f"{output_path}.partial", {"anon_name": anon_id}))
 
-def anonymisation(script_path, file_path, anon_id):
-    custom_script_path = anon_insertion(anon_id, script_path)
+    completed = []
+    failures = []
+    for (file_path, anon_id), result in zip(batch, anonymisation_service.anonymise_batch(jobs)):
+        if result.ok:
+            os.replace(result.output_path, output_path_for(file_path))
+            completed.append(file_path)
+        else:
+            if os.path.exists(result.output_path):
+                os.remove(result.output_path)
+            failures.append([file_path, output_path_for(file_path), anon_id, result.status, result.error])
 
-    jar_path = "dicom-edit.jar"
-    run_jar = f"java -jar {jar_path}"
+    return completed, failures
 
-    print(f"modified/fixed/{file_path[len(rtss_folder):]}")
 
-    command = f"{run_jar} -s {custom_script_path} -i {file_path} -o modified/fixed/{file_path[len(rtss_folder):]}"
-    anon = subprocess.Popen(command.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    jar_error = anon.stderr.read().decode('utf-8')
+def write_failure_report(failures):
+    now = str(datetime.datetime.now())[:19].replace(":", "_").replace(" ", "_")
+    report_path = f"logs/{now}_local_anon_failures.csv"
 
-    if re.search(r"\b" + re.escape('error') + r"\b", jar_error, flags=re.IGNORECASE):
-        print("Error in anonymisation;", jar_error)
-        raise SystemExit
+    with open(report_path, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file, delimiter=',')
+        writer.writerow(["Input File", "Output File", "Anon ID", "Status", "Error"])
+        writer.writerows(failures)
+
+    return report_path
+
+
+def cli_args():
+    parser = argparse.ArgumentParser(
+        description="A program to anonymise a folder of DICOM files into modified/fixed/, resuming an earlier "
+                    "interrupted run where it can.")
+
+    parser.add_argument("-w", "--workers",
+                        help="number of DicomEdit JVMs for scripts the in-process interpreter can't run", default=2,
+                        type=int)
+    parser.add_argument("-p", "--processes",
+                        help="number of processes for the in-process interpreter, defaults to the number of cores",
+                        default=None, type=int)
+    parser.add_argument("-b", "--batch_size",
+                        help="number of files handed to the workers at a time", default=512, type=int)
+    parser.add_argument("-r", "--restart",
+                        help="ignore any checkpoint and anonymise every file again", action="store_true")
+
+    args_int = parser.parse_args()
+    return args_int
 
 
 def main():
-    filepaths = find_files()
     script_path = askopenfilename(title="Choose an anonymisation profile")
     example_id = input("Enter example anon ID: ")
 
-    for file in filepaths:
-        anon_id = file[len(rtss_folder):len(rtss_folder)+len(example_id)]
-        print("Processing: ", anon_id)
-        anonymisation(script_path, file, anon_id)
+    checkpoint = Checkpoint(CHECKPOINT_PATH, script_path, args.restart)
+    pending_files = ((file, file[len(rtss_folder):len(rtss_folder)+len(example_id)])
+                     for file in sop_classifier.find_files(rtss_folder, sort=True) if not checkpoint.is_done(file))
+
+    completed_count = 0
+    failures = []
+    finished = False
+    try:
+        with anonymiser.AnonymisationService(script_path, anon_insertion, workers=args.workers,
+                                             processes=args.processes) as anonymisation_service:
+            while True:
+                batch = list(islice(pending_files, args.batch_size))
+                if not batch:
+                    break
+
+                completed, batch_failures = anonymise_batch(anonymisation_service, batch)
+                checkpoint.mark_done(completed)
+                completed_count += len(completed)
+                failures += batch_failures
+
+                print(f"Anonymised {completed_count} files, {len(failures)} failed")
+        finished = not failures
+    finally:
+        checkpoint.close(finished)
+
+    if checkpoint.completed:
+        print(f"Skipped {len(checkpoint.completed)} files completed by an earlier run")
+
+    if failures:
+        report_path = write_failure_report(failures)
+        print(f"{len(failures)} files could not be anonymised, see {report_path}")
 
 
 if __name__ == "__main__":
+    args = cli_args()
     rtss_folder = input("Path to files: ")
     main()
@@ -2,15 +2,15 @@
 
 # Author: Jason Lunn, The Institute of Cancer Research, UK
 
+import io
 import json
+import zipfile
+import argparse
 import pydicom
 import getpass
 from tkinter import filedialog
 from pathlib import Path
 import requests
-import shutil
-import os
-import tempfile
 from progress.bar import Bar
 
 
@@ -20,6 +20,25 @@ class FancyBar(Bar):
     suffix = '%(percent).2f%% - %(eta)ds'
 
 
+class ZipChunkBuffer:
+    # write-only target for zipfile, handing back whatever has been written since the last take()
+    # zipfile sees it can't seek and writes a data descriptor after each entry instead of going back to the header
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
 def get_xnat_details():
 
     with open("login_details.json", 'r') as details_file:
@@ -40,84 +59,117 @@ def select_data_folder():
     return directory
 
 
+def set_patient_comments(dcm_dataset, project_id):
+    subject_name = dcm_dataset['00100010'].value
+    scan_date = dcm_dataset['00080020'].value
+    scan_time = dcm_dataset['00080030'].value
+    full_scanner_name = dcm_dataset['00081090'].value
+    # scanner_name = full_scanner_name.split()[0]
+
+    session_label = f"{scan_date}_{scan_time}_{full_scanner_name}"
+
+    patient_comments = f"Project: {project_id}; Subject: {subject_name}; Session: {session_label}; AA:True"
+    dcm_dataset['00104000'].value = patient_comments
+
+
 def append_patient_comments_tag(directory, project_id):
     # spinner = Spinner('Preparing data for XNAT upload... ')
     files = Path(directory).rglob('*.dcm')
     for file in files:
         dcm_dataset = pydicom.read_file(file)
-        subject_name = dcm_dataset['00100010'].value
-        scan_date = dcm_dataset['00080020'].value
-        scan_time = dcm_dataset['00080030'].value
-        full_scanner_name = dcm_dataset['00081090'].value
-        # scanner_name = full_scanner_name.split()[0]
-
-        session_label = f"{scan_date}_{scan_time}_{full_scanner_name}"
-
-        patient_comments = f"Project: {project_id}; Subject: {subject_name}; Session: {session_label}; AA:True"
-        dcm_dataset['00104000'].value = patient_comments
+        set_patient_comments(dcm_dataset, project_id)
         dcm_dataset.save_as(file)
 
         # spinner.next()
 
 
-def send_to_xnat(xnat_session, domain, directory, project_id):
+def prepare_file(file, project_id):
+    # the Patient Comments are rewritten in memory, the file on disk is left as it is
+    dcm_dataset = pydicom.read_file(file)
+    set_patient_comments(dcm_dataset, project_id)
 
-    files = Path(directory).rglob('*.dcm')
-    files_list = list(files)
-    total_files = len(files_list)
-    with tempfile.TemporaryDirectory(dir=Path("temp/")) as temp_area:
-        file_area = Path(f"{temp_area}/file_area")
-        make_file_dir(file_area)
-        print("\n")
-        with FancyBar('Uploading data to XNAT... ', max=total_files) as bar:
-            for i, file in enumerate(files_list):
-                temp_file = Path(f"{temp_area}/file_area/{file.stem}{file.suffix}")
-                shutil.copyfile(file, temp_file)
+    file_buffer = io.BytesIO()
+    dcm_dataset.save_as(file_buffer)
+
+    return file_buffer.getvalue()
+
+
+def make_batches(files_list, batch_files, batch_bytes):
+    # batches close at batch_files files or once they hold batch_bytes of source data, whichever comes first
+    batch = []
+    batch_size = 0
+    for file in files_list:
+        batch.append(file)
+        batch_size += file.stat().st_size
+
+        if len(batch) >= batch_files or batch_size >= batch_bytes:
+            yield batch
+            batch = []
+            batch_size = 0
+
+    if batch:
+        yield batch
 
-                # send DICOM files in batches to prevent spamming requests to the server
-                if i % 200 == 0 or i % (total_files - 1) == 0:
-                    append_patient_comments_tag(file_area, project_id)
-                    zip_temp_area = Path(f"{temp_area}/zipped_up")
-                    shutil.make_archive(zip_temp_area, 'zip', file_area)
 
-                    with open(f"{zip_temp_area}.zip", 'rb') as data:
-                        file_upload_request = xnat_session.post(f'{domain}/data/services/import'
-                                                                f'?inbody=true&import-handler=DICOM-zip'
-                                                                f'&dest=/archive', data=data)
+def stream_zip(directory, batch, project_id, bar):
+    # generator used as the request body, so the zip is built as it is sent and never exists in full
+    zip_buffer = ZipChunkBuffer()
+
+    # entries have to be deflated, Java's ZipInputStream on the XNAT side rejects stored entries that are followed
+    # by a data descriptor, and level 1 keeps the compression cost low
+    with zipfile.ZipFile(zip_buffer, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=1) as zip_stream:
+        for file in batch:
+            zip_stream.writestr(file.relative_to(directory).as_posix(), prepare_file(file, project_id))
+            yield zip_buffer.take()
+            bar.next()
+
+    # the central directory, written as the zip is closed
+    yield zip_buffer.take()
+
+
+def send_to_xnat(xnat_session, domain, directory, project_id, batch_files=200, batch_bytes=512 * 1024 ** 2):
+    files_list = sorted(Path(directory).rglob('*.dcm'))
+    total_files = len(files_list)
 
-                    clean_temp_dir(temp_area)
-                    make_file_dir(file_area)
+    print("\n")
+    with FancyBar('Uploading data to XNAT... ', max=total_files) as bar:
+        # send DICOM files in batches to prevent spamming requests to the server
+        for batch in make_batches(files_list, batch_files, batch_bytes):
+            file_upload_request = xnat_session.post(f'{domain}/data/services/import'
+                                                    f'?inbody=true&import-handler=DICOM-zip'
+                                                    f'&dest=/archive',
+                                                    data=stream_zip(directory, batch, project_id, bar))
 
-                bar.next()
+            if not file_upload_request.ok:
+                print(f"\nUpload of {len(batch)} files starting {batch[0]} failed: "
+                      f"{file_upload_request.status_code} {file_upload_request.text}")
 
 
-def make_file_dir(location):
-    Path(location).mkdir(parents=True, exist_ok=True)
+def cli_args():
+    parser = argparse.ArgumentParser(
+        description="A program to upload a local folder of DICOM files to an XNAT archive, in zipped batches.")
 
+    parser.add_argument("-b", "--batch_files",
+                        help="maximum number of files in each upload", default=200, type=int)
+    parser.add_argument("-m", "--batch_mb",
+                        help="maximum size of each upload in MB, measured on the source files", default=512,
+                        type=int)
 
-def clean_temp_dir(folder):
-    for filename in os.listdir(folder):
-        file_path = os.path.join(folder, filename)
-        try:
-            if os.path.isfile(file_path) or os.path.islink(file_path):
-                os.unlink(file_path)
-            elif os.path.isdir(file_path):
-                shutil.rmtree(file_path)
-        except Exception as e:
-            print('Failed to delete %s. Reason: %s' % (file_path, e))
+    args_int = parser.parse_args()
+    return args_int
 
 
 def main():
-    # clean_temp_dir("temp")
     domain, username, password, project_id = get_xnat_details()
     data_directory = select_data_folder()
     # append_patient_comments_tag(data_directory, project_id)
     with requests.Session() as xnat_session:
         xnat_session.auth = (username, password)
-        send_to_xnat(xnat_session, domain, data_directory, project_id)
+        send_to_xnat(xnat_session, domain, data_directory, project_id, args.batch_files, args.batch_mb * 1024 ** 2)
 
     print("\nUpload Complete!")
 
 
 if __name__ == "__main__":
+    args = cli_args()
     main()
@@ -8,12 +8,143 @@ import re
 import csv
 import json
 import os
+import shutil
 import subprocess
 import datetime
 import pydicom
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 from tkinter.filedialog import askopenfilename, askdirectory
-from difflib import get_close_matches
+from difflib import SequenceMatcher
+from collections import Counter
+
+import roi_subset
+import anonymiser.anonymiser as anonymiser
+import sop_classifier.sop_classifier as sop_classifier
+
+
+class RtssFileIndex:
+    # persistent index of the .dcm files under rtss_folder, refreshed by directory and file mtimes between runs
+    def __init__(self, root_folder, index_path="modified/rtss_file_index.json", read_patient_names=False):
+        self.root_folder = str(root_folder)
+        self.index_path = index_path
+        self.read_patient_names = read_patient_names
+
+        self.directories = {}
+        self.files = {}
+        self.by_patient_name = {}
+
+        self.load()
+        self.refresh()
+        self.save()
+
+    def load(self):
+        if not os.path.exists(self.index_path):
+            return
+
+        with open(self.index_path, 'r') as f:
+            saved_index = json.load(f)
+
+        # an index of a different folder, or one without patient names when they are wanted, is rebuilt
+        if saved_index['root_folder'] == self.root_folder and \
+                (saved_index['read_patient_names'] or not self.read_patient_names):
+            self.directories = saved_index['directories']
+            self.files = saved_index['files']
+
+    def save(self):
+        saved_index = {"root_folder": self.root_folder,
+                       "read_patient_names": self.read_patient_names,
+                       "directories": self.directories,
+                       "files": self.files}
+
+        temp_path = f"{self.index_path}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(saved_index, f)
+        os.replace(temp_path, self.index_path)
+
+    def refresh(self):
+        previous_files = self.files
+        self.files = {}
+        self.scan_directory(self.root_folder, previous_files)
+
+        # directories no longer reachable from the root have been removed
+        reachable = set()
+        pending = [self.root_folder]
+        while pending:
+            directory = pending.pop()
+            reachable.add(directory)
+            pending.extend(os.path.join(directory, name) for name in self.directories[directory]['subdirs'])
+        self.directories = {directory: details for directory, details in self.directories.items()
+                            if directory in reachable}
+
+        self.build_lookups()
+
+    def scan_directory(self, directory, previous_files):
+        directory_mtime = os.stat(directory).st_mtime
+        cached_directory = self.directories.get(directory)
+
+        if cached_directory is not None and cached_directory['mtime'] == directory_mtime:
+            # no entries were added or removed, so reuse the listing instead of reading the directory again
+            file_names = cached_directory['files']
+            subdirectory_names = cached_directory['subdirs']
+        else:
+            file_names = []
+            subdirectory_names = []
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        # symlinked folders are left out, as os.walk and sop_classifier.walk_files do
+                        if not entry.is_symlink():
+                            subdirectory_names.append(entry.name)
+                    elif entry.name.endswith(".dcm"):
+                        file_names.append(entry.name)
+            self.directories[directory] = {"mtime": directory_mtime, "files": file_names,
+                                           "subdirs": subdirectory_names}
+
+        for file_name in file_names:
+            file_path = os.path.join(directory, file_name)
+            self.files[file_path] = self.file_details(file_path, previous_files.get(file_path))
+
+        for subdirectory_name in subdirectory_names:
+            self.scan_directory(os.path.join(directory, subdirectory_name), previous_files)
+
+    def file_details(self, file_path, previous_details):
+        if not self.read_patient_names:
+            return {"mtime": None, "patient_name": None}
+
+        file_mtime = os.stat(file_path).st_mtime
+        if previous_details is not None and previous_details['mtime'] == file_mtime:
+            return previous_details
+
+        try:
+            header = pydicom.read_file(file_path, force=True, stop_before_pixels=True, specific_tags=['PatientName'])
+            patient_name = str(header['00100010'].value)
+        except Exception:
+            patient_name = None
+
+        return {"mtime": file_mtime, "patient_name": patient_name}
+
+    def build_lookups(self):
+        self.by_patient_name = {}
+
+        for file_path, details in self.files.items():
+            if details['patient_name'] is not None:
+                self.by_patient_name.setdefault(details['patient_name'], []).append(file_path)
+
+    def find(self, anon_id):
+        # the same filename substring match as find_file, in the same walk order, over the in-memory names,
+        # followed by any other files whose PatientName is anon_id
+        matches = [file_path for file_path in self.files if anon_id in os.path.basename(file_path)]
+        matched = set(matches)
+        matches += [file_path for file_path in self.by_patient_name.get(anon_id, []) if file_path not in matched]
+
+        return matches
+
+    def all_files(self):
+        return list(self.files)
+
+    def patient_name(self, file_path):
+        return self.files[file_path]['patient_name']
 
 
 def read_input_file():
@@ -25,6 +156,9 @@ def read_input_file():
 
 
 def find_file(anon_id):
+    if file_index is not None:
+        return file_index.find(anon_id)
+
     filepaths = []
     for root, dirs, files in os.walk(rtss_folder):
         for file in files:
@@ -35,6 +169,9 @@ def find_file(anon_id):
 
 
 def find_all_files():
+    if file_index is not None:
+        return file_index.all_files()
+
     filepaths = []
     for root, dirs, files in os.walk(rtss_folder):
         for file in files:
@@ -44,51 +181,63 @@ def find_all_files():
     return filepaths
 
 
-def read_dicom_file(file):
-    header = pydicom.read_file(file, force=True, stop_before_pixels=True)
+class RtStructFile:
+    # a single header read of an RTSTRUCT, keeping only what the edit pipeline needs from it
+    def __init__(self, filename):
+        self.filename = filename
+        self.patient_name = None
+        self.modality = ""
+        self.roi_names = {}
+        self.empty_roi_names = []
+
+        sop_class_uid = sop_classifier.classify_file(filename)
+        if sop_class_uid is not None and sop_class_uid != sop_classifier.RT_STRUCTURE_SET_STORAGE:
+            # known from its File Meta not to be an RTSTRUCT, so only the name and modality are read
+            dataset = pydicom.read_file(filename, force=True, stop_before_pixels=True,
+                                        specific_tags=['PatientName', 'Modality'])
+        else:
+            # ContourData values above defer_size are left unread, as only the presence of ContourSequence is
+            # checked
+            dataset = pydicom.read_file(filename, force=True, stop_before_pixels=True, defer_size="1 KB")
 
-    return header
+        if '00100010' in dataset:
+            self.patient_name = str(dataset['00100010'].value)
+        if '00080060' in dataset:
+            self.modality = str(dataset['00080060'].value)
 
+        if self.is_rtstruct():
+            for seq in dataset.StructureSetROISequence:
+                self.roi_names[seq.ROINumber] = seq.ROIName
 
-def get_roi_labels(filename):
-    file = pydicom.read_file(filename, force=True)
-    labels = []
-    file_type_check = False
-    if 'RTSTRUCT' in file.Modality:
-        file_type_check = True
-        sequences = file.StructureSetROISequence
+            for seq in dataset.ROIContourSequence:
+                if 'ContourSequence' not in seq:
+                    self.empty_roi_names.append(self.roi_names[seq.ReferencedROINumber])
 
-        for sequence in sequences:
-            label = sequence.ROIName
-            labels.append(label)
-    else:
-        msg = "The file object is not recognised as being RTS"
-        # raise Exception(msg)
+    def is_rtstruct(self):
+        return 'RTSTRUCT' in self.modality
 
-    return labels, file_type_check
 
+def read_rtstruct(file):
+    # files can arrive already parsed, e.g. from the --strings search in main
+    if isinstance(file, RtStructFile):
+        return file
 
-def empty_roi_check(filename):
-    file = pydicom.read_file(filename, force=True)
+    return RtStructFile(file)
 
-    empty_roi_list = []
-    roi_dict = {}
 
-    if 'RTSTRUCT' in file.Modality:
+def get_roi_labels(rtstruct):
+    labels = list(rtstruct.roi_names.values())
+    file_type_check = rtstruct.is_rtstruct()
 
-        info_sequence = file.StructureSetROISequence
-        for seq in info_sequence:
-            roi_dict[seq.ROINumber] = seq.ROIName
+    if not file_type_check:
+        msg = "The file object is not recognised as being RTS"
+        # raise Exception(msg)
+
+    return labels, file_type_check
 
-        contour_sequence = file.ROIContourSequence
-        for seq in contour_sequence:
-            try:
-                contour_metadata = seq.ContourSequence
-            except AttributeError as e:
-                # print(e)
-                roi_number_contour = seq.ReferencedROINumber
-                roi_name = roi_dict[roi_number_contour]
-                empty_roi_list.append(roi_name)
+
+def empty_roi_check(rtstruct):
+    empty_roi_list = list(rtstruct.empty_roi_names)
 
     return empty_roi_list
 
@@ -105,39 +254,102 @@ def compare_labels(requested_labels, all_labels, patient_id):
     return missing
 
 
-def label_conversion(missing_list, full_list, changes, anon_id):
-    matches = []
-    for missing in missing_list:
-        match = get_close_matches(missing, full_list, n=3, cutoff=0.75)
+class LabelMatcher:
+    # drop-in for difflib.get_close_matches over ROI labels, memoising work across every patient in a run
+    def __init__(self, n=3, cutoff=0.75):
+        self.n = n
+        self.cutoff = cutoff
+
+        self.char_counts = {}
+        self.digit_signatures = {}
+        self.scores = {}
+        self.decisions = {}
+
+    def get_char_counts(self, label):
+        # single characters (1-grams) are the only n-grams that give an exact upper bound on the match ratio
+        if label not in self.char_counts:
+            self.char_counts[label] = Counter(label)
+        return self.char_counts[label]
+
+    def get_digit_signature(self, label):
+        if label not in self.digit_signatures:
+            self.digit_signatures[label] = ''.join(filter(str.isdigit, label))
+        return self.digit_signatures[label]
+
+    def score(self, missing, label):
+        # returns the SequenceMatcher ratio, or None if a cheaper upper bound already falls below the cutoff
+        if (missing, label) not in self.scores:
+            total_length = len(missing) + len(label)
+            ratio = None
+
+            if total_length and 2.0 * min(len(missing), len(label)) / total_length >= self.cutoff:
+                common_chars = sum((self.get_char_counts(missing) & self.get_char_counts(label)).values())
+                if 2.0 * common_chars / total_length >= self.cutoff:
+                    ratio = SequenceMatcher(None, label, missing).ratio()
+
+            self.scores[(missing, label)] = ratio
+        return self.scores[(missing, label)]
+
+    def get_close_matches(self, missing, full_list):
+        candidates = []
+        for label in full_list:
+            ratio = self.score(missing, label)
+            if ratio is not None and ratio >= self.cutoff:
+                candidates.append((ratio, label))
+
+        # same ordering as difflib.get_close_matches, best score first with ties broken on the label
+        candidates.sort(reverse=True)
+        return [label for ratio, label in candidates[:self.n]]
+
+    def convert(self, missing, full_list):
+        # returns the labels to include in place of 'missing', and the change log lines describing the decision
+        decision_key = (missing, tuple(sorted(full_list)))
+        if decision_key in self.decisions:
+            return self.decisions[decision_key]
+
+        matches = []
+        alter_strings = []
+        match = self.get_close_matches(missing, full_list)
         # print(f"MATCHES FOUND for {missing}: ", match)
         if match:
 
-            digits_only_missing = ''.join(filter(str.isdigit, missing))
+            digits_only_missing = self.get_digit_signature(missing)
             if digits_only_missing != "":
                 for i in range(len(match)):
-                    digits_only_match = ''.join(filter(str.isdigit, match[i]))
+                    digits_only_match = self.get_digit_signature(match[i])
 
                     if digits_only_missing == digits_only_match:
                         matches.append(match[i])
-                        alter_string = f" \'{missing}\' ==> \'{match[i]}\' ({i+1}/{len(match)})"
-                        changes.append((anon_id, alter_string))
+                        alter_strings.append(f" \'{missing}\' ==> \'{match[i]}\' ({i+1}/{len(match)})")
                         break
                     else:
-                        alter_string = f" \'{missing}\' IS NOT \'{match[i]}\' ({i+1}/{len(match)})"
-                        changes.append((anon_id, alter_string))
+                        alter_strings.append(f" \'{missing}\' IS NOT \'{match[i]}\' ({i+1}/{len(match)})")
 
             else:
                 matches.append(match[0])
-                alter_string = f" \'{missing}\' ==> \'{match[0]}\'"
-                changes.append((anon_id, alter_string))
+                alter_strings.append(f" \'{missing}\' ==> \'{match[0]}\'")
         else:
             matches.append(missing)
-            no_string = f"Couldn't find replacement for \'{missing}\'"
-            changes.append((anon_id, no_string))
+            alter_strings.append(f"Couldn't find replacement for \'{missing}\'")
+
+        self.decisions[decision_key] = (matches, alter_strings)
+        return matches, alter_strings
+
+
+def label_conversion(missing_list, full_list, changes, anon_id):
+    matches = []
+    for missing in missing_list:
+        missing_matches, alter_strings = label_matcher.convert(missing, full_list)
+        matches.extend(missing_matches)
+        changes.extend((anon_id, alter_string) for alter_string in alter_strings)
 
     return matches
 
 
+# built once per run (and per worker process), so label comparisons are shared between patients
+label_matcher = LabelMatcher()
+
+
 def rtsedit(anon_id, input_data, files, wrong_list, changes_list, empty_list):
     clean_edit = False
     roi_info = "BLANK"
@@ -145,10 +357,11 @@ def rtsedit(anon_id, input_data, files, wrong_list, changes_list, empty_list):
     edit_path = "../etherj-cli-tools/bin/rtsedit"
 
     # add feature to look in all relevant files and split ROIs correctly
-    for file in files:
+    for rtstruct in map(read_rtstruct, files):
+        file = rtstruct.filename
         include_rois = input_data
-        found_labels, file_type_bool = get_roi_labels(file)
-        empty_labels = empty_roi_check(file)
+        found_labels, file_type_bool = get_roi_labels(rtstruct)
+        empty_labels = empty_roi_check(rtstruct)
 
         if args.strings:
             include_rois = []
@@ -196,27 +409,46 @@ def rtsedit(anon_id, input_data, files, wrong_list, changes_list, empty_list):
             # command = f"{edit_path} --label MOD_+ --include \"{joint.join(include_rois)}\" --output {output_file} {file}"
             command_list = [edit_path, "--label", "ALT_RTSS", "--include", *rois, "--output", output_file, file]
 
-            edit = subprocess.Popen(command_list, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-            edit_error = edit.stderr.read().decode('utf-8')
-            # if re.search(r"\b" + re.escape('exception') + r"\b", edit_error, flags=re.IGNORECASE):
-            #     print("Error in rtsedit process;\n\n", edit_error)
-            #     wrong_list.append([anon_id, "ERROR"])
-            # raise SystemExit
-            error_bool = re.search(r"\b" + re.escape('exception') + r"\b", edit_error, flags=re.IGNORECASE)
-            edit_output = edit.stdout.read().decode('utf-8')
-            print(edit_output)
-            output_bool = re.search(r"\b" + re.escape('not found') + r"\b", edit_output, flags=re.IGNORECASE)
+            if args.native:
+                subset_result = roi_subset.subset_rois_file(file, output_file, include_rois, label="ALT_RTSS",
+                                                            copy_date=True)
+                edit_output = subset_result.summary()
+                print(edit_output)
 
-            no_changes_bool = re.search(r"\b" + re.escape('No ROIs would be removed')
-                                        + r"\b", edit_output, flags=re.IGNORECASE)
+                error_bool = subset_result.status == roi_subset.EMPTY
+                output_bool = bool(subset_result.missing_rois)
+                no_changes_bool = subset_result.status == roi_subset.UNCHANGED
+            else:
+                if edit_worker is not None:
+                    edit_status, edit_output, edit_error = edit_worker.run_tool("rtsedit", command_list[1:])
+                else:
+                    edit = subprocess.Popen(command_list, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+                    # read both pipes together, so a child filling one of them cannot deadlock
+                    edit_output, edit_error = edit.communicate()
+                    edit_output = edit_output.decode('utf-8')
+                    edit_error = edit_error.decode('utf-8')
+                # if re.search(r"\b" + re.escape('exception') + r"\b", edit_error, flags=re.IGNORECASE):
+                #     print("Error in rtsedit process;\n\n", edit_error)
+                #     wrong_list.append([anon_id, "ERROR"])
+                # raise SystemExit
+                error_bool = re.search(r"\b" + re.escape('exception') + r"\b", edit_error, flags=re.IGNORECASE)
+                print(edit_output)
+                output_bool = re.search(r"\b" + re.escape('not found') + r"\b", edit_output, flags=re.IGNORECASE)
+
+                no_changes_bool = re.search(r"\b" + re.escape('No ROIs would be removed')
+                                            + r"\b", edit_output, flags=re.IGNORECASE)
 
             if no_changes_bool and args.changes:
                 print("Copying file...")
                 global copy_count
                 copy_count += 1
                 copy_file(file, output_file)
-            label_edit(output_file)
+                if args.native:
+                    roi_subset.copy_structure_set_date_file(output_file)
+            # the native path applies rtssLabelEdit.das itself, so DicomEdit only runs on rtsedit's output
+            if not args.native:
+                label_edit(output_file)
 
             if not error_bool and not output_bool:
                 clean_edit = True
@@ -230,13 +462,13 @@ def rtsedit(anon_id, input_data, files, wrong_list, changes_list, empty_list):
 
 
 def move_file(filepath, filename):
-    move_cmd = f"mv {filepath} modified/bad_edit/{filename}"
-    move = subprocess.Popen(move_cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    # rtsedit does not always write an output file, so there may be nothing to move
+    if os.path.exists(filepath):
+        shutil.move(filepath, f"modified/bad_edit/{filename}")
 
 
 def copy_file(filepath, filename):
-    copy_cmd = f"cp {filepath} {filename}"
-    copy = subprocess.Popen(copy_cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    shutil.copyfile(filepath, filename)
 
 
 def dot_das_insertion():
@@ -266,14 +498,60 @@ def label_edit(file_path):
     run_jar = f"java -jar {jar_path}"
 
     command = f"{run_jar} -s {custom_script_path} -i {file_path} -o {file_path}"
-    anon = subprocess.Popen(command.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    jar_error = anon.stderr.read().decode('utf-8')
+    if edit_worker is not None:
+        jar_status, jar_output, jar_error = edit_worker.run(command.split()[3:])
+    else:
+        anon = subprocess.Popen(command.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        jar_output, jar_error = anon.communicate()
+        jar_error = jar_error.decode('utf-8')
 
     if re.search(r"\b" + re.escape('error') + r"\b", jar_error, flags=re.IGNORECASE):
         print("Error in anonymisation;", jar_error)
         raise SystemExit
 
 
+def init_edit_process(parent_args, parent_rtss_folder, parent_script_path):
+    # worker processes do not run the __main__ block, so copy across the globals the edit pipeline relies on
+    global args, rtss_folder, script_path, copy_count, edit_worker
+    args = parent_args
+    rtss_folder = parent_rtss_folder
+    script_path = parent_script_path
+    copy_count = 0
+    edit_worker = None
+    if args.worker:
+        edit_worker = anonymiser.DicomEditWorker("../dicom-edit.jar", "../etherj-cli-tools/lib")
+
+
+def edit_patient(message, anon_id, input_data, files):
+    # run one patient's edit pipeline with its own accumulators, returned for merging by the parent process
+    global copy_count
+    copy_count = 0
+    wrong_list = {}
+    changes_list = []
+    empty_list = {}
+
+    print(message)
+    rtsedit(anon_id, input_data, files, wrong_list, changes_list, empty_list)
+
+    return wrong_list, changes_list, empty_list, copy_count
+
+
+def parallel_rtsedit(edit_jobs, wrong_list, changes_list, empty_list):
+    global copy_count
+
+    with ProcessPoolExecutor(max_workers=args.jobs, initializer=init_edit_process,
+                             initargs=(args, rtss_folder, script_path)) as pool:
+        patient_results = [pool.submit(edit_patient, *edit_job) for edit_job in edit_jobs]
+
+        # merge in input order, so the accumulators and summary files match a sequential run
+        for patient_result in patient_results:
+            patient_wrong, patient_changes, patient_empty, patient_copies = patient_result.result()
+            wrong_list.update(patient_wrong)
+            changes_list.extend(patient_changes)
+            empty_list.update(patient_empty)
+            copy_count += patient_copies
+
+
 def save_summary(problems_dict, changes_list, empty_dict):
     now = str(datetime.datetime.now())
     now = now.replace(":", "_")
@@ -301,6 +579,25 @@ def cli_args():
     parser.add_argument("-n", "--changes",
                         help="enable copying unchanged files", default=False, action='store_true')
 
+    parser.add_argument("-w", "--worker",
+                        help="run every rtsedit and label edit in one long-lived JVM (requires Java 11+)",
+                        default=False, action='store_true')
+
+    parser.add_argument("-x", "--native",
+                        help="subset ROIs in-process with pydicom instead of running rtsedit", default=False,
+                        action='store_true')
+
+    parser.add_argument("-i", "--index",
+                        help="look files up in a persistent index of the RTSTRUCT folder", default=False,
+                        action='store_true')
+
+    parser.add_argument("-p", "--index_names",
+                        help="also index files by their PatientName header (implies --index)", default=False,
+                        action='store_true')
+
+    parser.add_argument("-j", "--jobs",
+                        help="number of patients to edit in parallel", default=1, type=int)
+
     args_int = parser.parse_args()
     return args_int
 
@@ -310,6 +607,7 @@ def main():
     wrong_list = {}
     changes_list = []
     empty_list = {}
+    edit_jobs = []
 
     if args.strings:
         print("Enter strings for search, enter \"DONE\" to move on.")
@@ -324,11 +622,15 @@ def main():
 
         files = find_all_files()
         for count, file in enumerate(files):
-            dicom_header = read_dicom_file(file)
-            anon_id = str(dicom_header['00100010'].value)
+            # parsed once here and handed on, so rtsedit does not read the file again
+            rtstruct = RtStructFile(file)
+            if rtstruct.patient_name is None:
+                print(f"\nSkipping {file}, it has no Patient Name to use as the subject ID")
+                continue
+            anon_id = rtstruct.patient_name
             num_of_files = len(files)
-            print(f"\nEditing RTSTRUCT for subject {anon_id} ({count+1}/{num_of_files})")
-            rtsedit(anon_id, roi_strings, [file], wrong_list, changes_list, empty_list)
+            message = f"\nEditing RTSTRUCT for subject {anon_id} ({count+1}/{num_of_files})"
+            edit_jobs.append((message, anon_id, roi_strings, [rtstruct]))
 
     else:
         data_list = read_input_file()
@@ -338,8 +640,15 @@ def main():
             count += 1
             anon_id = data[0]
             files = find_file(anon_id)
-            print(f"\nEditing RTSTRUCT for patient {anon_id} ({count}/{len(data_list)})")
-            rtsedit(anon_id, data[1:], files, wrong_list, changes_list, empty_list)
+            message = f"\nEditing RTSTRUCT for patient {anon_id} ({count}/{len(data_list)})"
+            edit_jobs.append((message, anon_id, data[1:], files))
+
+    if args.jobs > 1:
+        parallel_rtsedit(edit_jobs, wrong_list, changes_list, empty_list)
+    else:
+        for message, anon_id, input_data, files in edit_jobs:
+            print(message)
+            rtsedit(anon_id, input_data, files, wrong_list, changes_list, empty_list)
 
     if wrong_list:
         print(f"Patients for which files were not edited correctly;")
@@ -359,4 +668,12 @@ if __name__ == "__main__":
     rtss_folder = pathlib.Path(askdirectory())
     script_path = "rtssLabelEdit.das"
     copy_count = 0
+    edit_worker = None
+    if args.worker:
+        edit_worker = anonymiser.DicomEditWorker("../dicom-edit.jar", "../etherj-cli-tools/lib")
+    file_index = None
+    if args.index or args.index_names:
+        file_index = RtssFileIndex(rtss_folder, read_patient_names=args.index_names)
     main()
+    if edit_worker is not None:
+        edit_worker.close()
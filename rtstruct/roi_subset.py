@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+# Author: Jason Lunn, The Institute of Cancer Research, UK
+
+# In-process replacement for the etherj 'rtsedit --include' tool, keeping a subset of the ROIs in an RTSTRUCT
+import pydicom
+from pydicom.sequence import Sequence
+from pydicom.uid import generate_uid
+
+# outcomes of a subset edit, matching the cases rtsedit reports on stdout
+EDITED = "edited"
+UNCHANGED = "unchanged"
+EMPTY = "empty"
+
+
+class RoiSubsetResult:
+    def __init__(self, status, kept_rois, removed_rois, missing_rois):
+        self.status = status
+        self.kept_rois = kept_rois
+        self.removed_rois = removed_rois
+        self.missing_rois = missing_rois
+
+    def write_output(self):
+        # rtsedit only writes an output file when ROIs were removed and at least one is left
+        return self.status == EDITED
+
+    def summary(self):
+        lines = [f"Include: {roi}" for roi in self.kept_rois]
+        lines += [f"ROI to include '{roi}' not found" for roi in self.missing_rois]
+
+        if self.status == UNCHANGED:
+            lines.append("No ROIs would be removed")
+        elif self.status == EMPTY:
+            lines.append("Output RT-STRUCT would contain zero ROIs")
+
+        return "\n".join(lines)
+
+
+def subset_rois(dataset, include_rois, label=None):
+    # (3006, 0020) Structure Set ROI Sequence
+    structure_set_rois = dataset['30060020'].value
+    roi_names = {roi['30060022'].value: str(roi['30060026'].value) for roi in structure_set_rois}
+
+    wanted = set(include_rois)
+    kept_numbers = [number for number, name in roi_names.items() if name in wanted]
+    kept_rois = [roi_names[number] for number in kept_numbers]
+    removed_rois = [name for number, name in roi_names.items() if number not in kept_numbers]
+    missing_rois = [roi for roi in dict.fromkeys(include_rois) if roi not in roi_names.values()]
+
+    if not kept_numbers:
+        return RoiSubsetResult(EMPTY, kept_rois, removed_rois, missing_rois)
+    if not removed_rois:
+        return RoiSubsetResult(UNCHANGED, kept_rois, removed_rois, missing_rois)
+
+    kept = set(kept_numbers)
+    # (3006, 0022) ROI Number
+    dataset['30060020'].value = Sequence([roi for roi in structure_set_rois if roi['30060022'].value in kept])
+
+    # (3006, 0039) ROI Contour Sequence and (3006, 0080) RT ROI Observations Sequence,
+    # both pointing back at the ROI through (3006, 0084) Referenced ROI Number
+    for sequence_tag in ('30060039', '30060080'):
+        if sequence_tag in dataset:
+            items = dataset[sequence_tag].value
+            dataset[sequence_tag].value = Sequence([item for item in items if item['30060084'].value in kept])
+
+    if label is not None:
+        # (3006, 0002) Structure Set Label
+        dataset['30060002'].value = label
+
+    # the edited structure set is a new instance
+    new_instance_uid = generate_uid()
+    dataset.SOPInstanceUID = new_instance_uid
+    if getattr(dataset, 'file_meta', None) is not None and 'MediaStorageSOPInstanceUID' in dataset.file_meta:
+        dataset.file_meta.MediaStorageSOPInstanceUID = new_instance_uid
+
+    return RoiSubsetResult(EDITED, kept_rois, removed_rois, missing_rois)
+
+
+def copy_structure_set_date(dataset):
+    # what rtssLabelEdit.das does; (3006, 0008) Structure Set Date and (3006, 0009) Structure Set Time become
+    # (0008, 0020) Study Date and (0008, 0030) Study Time
+    dataset.StudyDate = dataset['30060008'].value if '30060008' in dataset else ""
+    dataset.StudyTime = dataset['30060009'].value if '30060009' in dataset else ""
+
+
+def copy_structure_set_date_file(file_path):
+    dataset = pydicom.read_file(file_path, force=True)
+    copy_structure_set_date(dataset)
+    dataset.save_as(file_path)
+
+
+def subset_rois_file(input_path, output_path, include_rois, label=None, copy_date=False):
+    # copy_date applies rtssLabelEdit.das to the output as well, without running DicomEdit
+    dataset = pydicom.read_file(input_path, force=True)
+    result = subset_rois(dataset, include_rois, label)
+
+    if result.write_output():
+        if copy_date:
+            copy_structure_set_date(dataset)
+        dataset.save_as(output_path)
+
+    return result
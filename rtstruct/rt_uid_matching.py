@@ -3,12 +3,25 @@
 # Author: Jason Lunn, The Institute of Cancer Research, UK
 
 import os
+import shutil
+import argparse
+import tempfile
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 from tkinter.filedialog import askdirectory
 
 import pydicom
+import pydicom.uid
 import requests
+from pydicom.charset import convert_encodings
+from pydicom.dataelem import DataElement, DataElement_from_raw
+from pydicom.errors import InvalidDicomError
+from pydicom.filebase import DicomBytesIO
+from pydicom.filereader import read_preamble, _read_file_meta_info, data_element_generator
+from pydicom.filewriter import write_data_element
 
 import keystore.keystore as keystore
+import dicomdump.dicomdump as dicomdump
 
 
 def read_dicom_header(dicom_file_path):
@@ -64,33 +77,228 @@ def download_xnat_scan_header(domain, project_id, subject_id, session_id, scan_i
     request_object = xnat_session.get(f"{domain}/data/services/dicomdump?src=/archive/projects/{project_id}/"
                                       f"subjects/{subject_id}/experiments/{session_id}/scans/{scan_id}")
     request_json = request_object.json()
-    scan_header = request_json['ResultSet']['Result']
+    scan_header = dicomdump.DicomDump.from_json(request_json)
 
     return scan_header
 
 
-def get_tag_data_from_xnat_header(xnat_scan_header, tag_number: str):
-    found_tag_dict = list(filter(lambda tag_dict: tag_dict['tag1'] == tag_number, xnat_scan_header))[0]
+# (3006, 0010) Referenced Frame of Reference Sequence, the only element a UID edit touches
+REFERENCED_FRAME_OF_REFERENCE_SEQUENCE = 0x30060010
+# (is_implicit_VR, is_little_endian) of the transfer syntaxes that can be edited in place
+UID_EDIT_TRANSFER_SYNTAXES = {
+    pydicom.uid.ImplicitVRLittleEndian: (True, True),
+    pydicom.uid.ExplicitVRLittleEndian: (False, True),
+    pydicom.uid.ExplicitVRBigEndian: (False, False),
+}
+UID_EDIT_BUFFER_SIZE = 8 * 1024 * 1024
 
-    return found_tag_dict
 
+def set_referenced_uids(frame_of_reference_sequence, study_uid, series_uid):
+    study_item = frame_of_reference_sequence[0]['30060012'][0]
+    series_item = study_item['30060014'][0]
+
+    if study_item['00081155'].value == study_uid and series_item['0020000e'].value == series_uid:
+        return False
 
-def modify_local_file_uids(xnat_scan_header, local_file_header, local_file_path):
-    study_uid_tag_dict = get_tag_data_from_xnat_header(xnat_scan_header, '(0020,000D)')
-    series_uid_tag_dict = get_tag_data_from_xnat_header(xnat_scan_header, '(0020,000E)')
+    study_item['00081155'].value = study_uid
+    series_item['0020000e'].value = series_uid
 
-    study_uid = study_uid_tag_dict['value']
-    series_uid = series_uid_tag_dict['value']
+    return True
 
-    local_file_header['30060010'][0]['30060012'][0]['00081155'].value = study_uid
-    local_file_header['30060010'][0]['30060012'][0]['30060014'][0]['0020000e'].value = series_uid
 
-    local_file_header.save_as(local_file_path)
+def element_from_generator(element):
+    # data_element_generator hands back sequences of undefined length already parsed, everything else is raw
+    if isinstance(element, DataElement):
+        return element
+
+    return DataElement_from_raw(element)
+
+
+def find_frame_of_reference_element(local_file):
+    # locates the Referenced Frame of Reference Sequence in an open file, returning its byte range and raw element,
+    # or None where the file can't safely be edited in place
+    try:
+        read_preamble(local_file, False)
+    except InvalidDicomError:
+        return None
+    file_meta = _read_file_meta_info(local_file)
+
+    transfer_syntax = UID_EDIT_TRANSFER_SYNTAXES.get(file_meta.get('TransferSyntaxUID'))
+    if transfer_syntax is None:
+        return None
+    is_implicit_vr, is_little_endian = transfer_syntax
+
+    encodings = None
+    element_start = local_file.tell()
+    for raw_element in data_element_generator(local_file, is_implicit_vr, is_little_endian):
+        element_end = local_file.tell()
+
+        if raw_element.tag == 0x00080005:
+            # (0008, 0005) Specific Character Set
+            encodings = convert_encodings(element_from_generator(raw_element).value)
+        elif raw_element.tag.group == 0x3006 and raw_element.tag.element == 0:
+            # a group length would no longer be right once the sequence changes size
+            return None
+        elif raw_element.tag == REFERENCED_FRAME_OF_REFERENCE_SEQUENCE:
+            return element_start, element_end, raw_element, transfer_syntax, encodings
+        elif raw_element.tag > REFERENCED_FRAME_OF_REFERENCE_SEQUENCE:
+            return None
+
+        element_start = element_end
+
+    return None
+
+
+def copy_file_range(source_file, destination_file, length):
+    while length > 0:
+        chunk = source_file.read(min(length, UID_EDIT_BUFFER_SIZE))
+        if not chunk:
+            break
+        destination_file.write(chunk)
+        length -= len(chunk)
+
+
+def replace_file_atomically(local_file_path, write_contents):
+    # writes into a temporary file next to the original, then renames it over the original
+    local_folder = os.path.dirname(os.path.abspath(local_file_path))
+    temp_file = tempfile.NamedTemporaryFile(dir=local_folder, suffix=".tmp", delete=False)
+    try:
+        with temp_file:
+            write_contents(temp_file)
+        shutil.copymode(local_file_path, temp_file.name)
+        os.replace(temp_file.name, local_file_path)
+    except BaseException:
+        os.remove(temp_file.name)
+        raise
+
+
+def rewrite_local_file_uids(local_file_path, study_uid, series_uid):
+    # copy-on-write edit, only the Referenced Frame of Reference Sequence is re-encoded and everything either side
+    # of it is copied across byte for byte
+    with open(local_file_path, 'rb') as local_file:
+        located_element = find_frame_of_reference_element(local_file)
+
+        if located_element is None:
+            return rewrite_local_file_uids_fully(local_file_path, study_uid, series_uid)
+
+        element_start, element_end, raw_element, transfer_syntax, encodings = located_element
+        frame_of_reference_sequence = element_from_generator(raw_element)
+
+        if not set_referenced_uids(frame_of_reference_sequence, study_uid, series_uid):
+            return False
+
+        element_buffer = DicomBytesIO()
+        element_buffer.is_implicit_VR, element_buffer.is_little_endian = transfer_syntax
+        write_data_element(element_buffer, frame_of_reference_sequence, encodings)
+
+        def write_contents(temp_file):
+            local_file.seek(0)
+            copy_file_range(local_file, temp_file, element_start)
+            temp_file.write(element_buffer.getvalue())
+            local_file.seek(element_end)
+            shutil.copyfileobj(local_file, temp_file, UID_EDIT_BUFFER_SIZE)
+
+        replace_file_atomically(local_file_path, write_contents)
+
+    return True
+
+
+def rewrite_local_file_uids_fully(local_file_path, study_uid, series_uid):
+    # fallback for files the in place edit can't handle, e.g. deflated or without a File Meta header
+    # the whole file is read, not just the header, so nothing is lost when it's written back
+    local_file_header = pydicom.read_file(local_file_path, force=True)
+
+    if not set_referenced_uids(local_file_header['30060010'], study_uid, series_uid):
+        return False
+
+    replace_file_atomically(local_file_path, local_file_header.save_as)
+
+    return True
+
+
+def apply_uid_edits(uid_edits, workers):
+    # uid_edits is a list of (file path, Study Instance UID, Series Instance UID)
+    edited_count = 0
+    failed_edits = []
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        edit_jobs = [(uid_edit[0], pool.submit(rewrite_local_file_uids, *uid_edit)) for uid_edit in uid_edits]
+
+        for file, edit_job in edit_jobs:
+            try:
+                if edit_job.result():
+                    edited_count += 1
+            except Exception as e:
+                failed_edits.append((file, e))
+
+    return edited_count, failed_edits
+
+
+def list_subject_scans(domain, project_id, subject_id):
+    subject_scans = []
+
+    list_of_sessions = search_xnat_sessions(domain, project_id, subject_id)
+    for session in list_of_sessions:
+        session_id = session['ID']
+        list_of_scans = search_xnat_scans(domain, session_id)
+        for scan in list_of_scans:
+            subject_scans.append((session_id, scan['ID']))
+
+    return subject_id, subject_scans
+
+
+def index_scan(domain, project_id, subject_id, session_id, scan_id):
+    xnat_scan_header = download_xnat_scan_header(domain, project_id, subject_id, session_id, scan_id)
+
+    scan_uids = xnat_scan_header.values('(0008,0060)', '(0020,0052)', '(0020,000D)', '(0020,000E)')
+    if None in scan_uids:
+        # scans without these tags in their dicomdump cannot be matched to an RTSTRUCT
+        return None
+
+    modality, frame_of_reference_uid, study_uid, series_uid = scan_uids
+
+    return (subject_id, frame_of_reference_uid, modality), (study_uid, series_uid)
+
+
+def build_frame_of_reference_index(domain, project_id, subject_ids, connections):
+    # (subject ID, Frame of Reference UID, Modality) -> (Study Instance UID, Series Instance UID)
+    frame_of_reference_index = {}
+
+    with ThreadPoolExecutor(max_workers=connections) as pool:
+        subject_scan_lists = pool.map(partial(list_subject_scans, domain, project_id), subject_ids)
+
+        scan_jobs = [pool.submit(index_scan, domain, project_id, subject_id, session_id, scan_id)
+                     for subject_id, subject_scans in subject_scan_lists
+                     for session_id, scan_id in subject_scans]
+
+        # filled in scan order, so where scans share a frame of reference the last one wins, as before
+        for scan_job in scan_jobs:
+            index_entry = scan_job.result()
+            if index_entry is not None:
+                index_key, index_uids = index_entry
+                frame_of_reference_index[index_key] = index_uids
+
+    return frame_of_reference_index
+
+
+def cli_args():
+    parser = argparse.ArgumentParser(
+        description="A program to link local RTSTRUCT files to the matching CT scans of an XNAT project.")
+
+    parser.add_argument("-c", "--connections",
+                        help="maximum number of concurrent requests to XNAT", default=8, type=int)
+    parser.add_argument("-w", "--workers",
+                        help="number of RTSTRUCT files to rewrite at once", default=4, type=int)
+
+    args_int = parser.parse_args()
+    return args_int
 
 
 def main():
     label, url, username, password = keystore.retrieve_entry_details()
     xnat_session.auth = (username, password)
+    adapter = requests.adapters.HTTPAdapter(pool_connections=args.connections, pool_maxsize=args.connections)
+    xnat_session.mount(url, adapter)
 
     project_id = input("Enter Project ID: ")
     subject_dict = get_xnat_subject_details(url, project_id)
@@ -98,6 +306,7 @@ def main():
     local_folder = askdirectory()
     dicom_files = find_dicom_files(local_folder)
 
+    local_files_to_match = []
     for file in dicom_files:
         local_dicom_header = read_dicom_header(file)
         patient_name = str(local_dicom_header['00100010'].value)
@@ -108,25 +317,27 @@ def main():
         except KeyError as e:
             continue
         else:
-            list_of_sessions = search_xnat_sessions(url, project_id, subject_id)
-            for session in list_of_sessions:
-                session_id = session['ID']
-                list_of_scans = search_xnat_scans(url, session_id)
-                for scan in list_of_scans:
-                    scan_id = scan['ID']
-                    xnat_scan_header = download_xnat_scan_header(url, project_id, subject_id, session_id, scan_id)
-                    modality_tag_dict = get_tag_data_from_xnat_header(xnat_scan_header, '(0008,0060)')
+            local_files_to_match.append((file, subject_id, frame_of_reference_uid))
+
+    subject_ids = list(dict.fromkeys(subject_id for file, subject_id, frame_uid in local_files_to_match))
+    frame_of_reference_index = build_frame_of_reference_index(url, project_id, subject_ids, args.connections)
+
+    uid_edits = []
+    for file, subject_id, frame_of_reference_uid in local_files_to_match:
+        matched_uids = frame_of_reference_index.get((subject_id, frame_of_reference_uid, 'CT'))
 
-                    if modality_tag_dict['value'] == 'CT':
-                        frame_uid_tag_dict = get_tag_data_from_xnat_header(xnat_scan_header, '(0020,0052)')
+        if matched_uids is not None:
+            study_uid, series_uid = matched_uids
+            uid_edits.append((file, study_uid, series_uid))
 
-                        if frame_uid_tag_dict['value'] == frame_of_reference_uid:
-                            modify_local_file_uids(xnat_scan_header, local_dicom_header, file)
+    edited_count, failed_edits = apply_uid_edits(uid_edits, args.workers)
 
-                    else:
-                        continue
+    print(f"Updated UIDs in {edited_count} of {len(uid_edits)} matched RTSTRUCT files")
+    for file, error in failed_edits:
+        print(f"Failed to update {file}: {error}")
 
 
 if __name__ == "__main__":
+    args = cli_args()
     with requests.Session() as xnat_session:
         main()
@@ -1,11 +1,20 @@
 import os
+import csv
+import json
 import pathlib
+import argparse
+import datetime
+import itertools
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 import pydicom
 import numpy as np
 import array
+from pydicom.dataelem import RawDataElement
 from tkinter.filedialog import askopenfilename, askdirectory
 
+import sop_classifier.sop_classifier as sop_classifier
+
 # input_file = askopenfilename(title="Select an RTSTRUCT file to analyse")
 # # input_file ="rtss_test/DICOM/anon_rtss.dcm"
 # ds = pydicom.read_file(input_file, force=True)
@@ -45,9 +54,201 @@ def get_roi_labels(input_file):
     return labels, modality
 
 
+def read_contour_data(contour_item):
+    # (3006, 0050) Contour Data, parsed from the raw DS text in one call rather than as one object per value
+    contour_data = contour_item.get_item(0x30060050)
+    if contour_data is None:
+        return np.empty((0, 3))
+
+    if isinstance(contour_data, RawDataElement):
+        raw_value = contour_data.value or b""
+        points = np.fromstring(raw_value.replace(b"\\", b" ").decode('ascii'), sep=" ")
+    else:
+        points = np.asarray(contour_data.value, dtype=float)
+
+    return points.reshape(-1, 3)
+
+
+def get_roi_contours(dataset):
+    # {ROI Number: (all contour points of the ROI stacked, start index of each contour)}
+    roi_contours = {}
+
+    # (3006, 0039) ROI Contour Sequence
+    for roi_contour in dataset.get('ROIContourSequence', []):
+        contour_arrays = [read_contour_data(contour) for contour in roi_contour.get('ContourSequence', [])]
+        contour_arrays = [points for points in contour_arrays if len(points)]
+
+        if contour_arrays:
+            contour_lengths = np.array([len(points) for points in contour_arrays])
+            points = np.concatenate(contour_arrays)
+            contour_starts = np.concatenate(([0], np.cumsum(contour_lengths)[:-1]))
+        else:
+            points = np.empty((0, 3))
+            contour_starts = np.empty(0, dtype=int)
+
+        roi_contours[roi_contour.ReferencedROINumber] = (points, contour_starts)
+
+    return roi_contours
+
+
+def contour_geometry(points, contour_starts):
+    geometry = {"contour_count": len(contour_starts), "point_count": len(points)}
+
+    if not len(points):
+        return geometry
+
+    for axis, name in enumerate("xyz"):
+        geometry[f"{name}_min"] = float(points[:, axis].min())
+        geometry[f"{name}_max"] = float(points[:, axis].max())
+
+    # shoelace area of every contour at once, pairing each point with the next one round its own contour
+    next_index = np.arange(1, len(points) + 1)
+    contour_ends = np.append(contour_starts[1:], len(points))
+    next_index[contour_ends - 1] = contour_starts
+    x, y = points[:, 0], points[:, 1]
+    cross_products = x * y[next_index] - x[next_index] * y
+    contour_areas = 0.5 * np.abs(np.add.reduceat(cross_products, contour_starts))
+
+    # axial contours lie on one slice each, so the slice position is the z of the contour's first point
+    slice_positions = np.unique(points[contour_starts, 2])
+    slice_spacing = float(np.median(np.diff(slice_positions))) if len(slice_positions) > 1 else 0.0
+
+    geometry["slice_count"] = len(slice_positions)
+    geometry["slice_spacing"] = slice_spacing
+    geometry["total_area_(mm^2)"] = float(contour_areas.sum())
+    geometry["volume_(mm^3)"] = float(contour_areas.sum()) * slice_spacing
+
+    return geometry
+
+
+def analyse_rtstruct(file, ds=None):
+    if ds is None:
+        ds = pydicom.read_file(file, force=True)
+    rows = []
+
+    if 'RTSTRUCT' not in str(ds.get('Modality', '')):
+        return rows
+
+    roi_names = {roi.ROINumber: roi.ROIName for roi in ds.get('StructureSetROISequence', [])}
+    roi_contours = get_roi_contours(ds)
+
+    for roi_number, roi_name in roi_names.items():
+        points, contour_starts = roi_contours.get(roi_number, (np.empty((0, 3)), np.empty(0, dtype=int)))
+        row = {"file": file, "roi_number": int(roi_number), "roi_name": str(roi_name)}
+        row.update(contour_geometry(points, contour_starts))
+        rows.append(row)
+
+    return rows
+
+
+ANALYSIS_FIELDNAMES = ["file", "roi_number", "roi_name", "contour_count", "point_count",
+                       "x_min", "x_max", "y_min", "y_max", "z_min", "z_max",
+                       "slice_count", "slice_spacing", "total_area_(mm^2)", "volume_(mm^3)"]
+
+
+def analyse_folder(rtss_folder):
+    date = datetime.datetime.today().strftime('%Y-%m-%d_%H%M%S')
+    output_filename = f"{date}_rtss_analysis.csv"
+
+    with open(output_filename, 'w', newline='') as output_file:
+        dict_writer = csv.DictWriter(output_file, fieldnames=ANALYSIS_FIELDNAMES)
+        dict_writer.writeheader()
+
+        for file in find_file(rtss_folder):
+            try:
+                dict_writer.writerows(analyse_rtstruct(file))
+            except Exception as e:
+                print(f"Could not analyse {file}: {e}")
+
+    print(f"Analysis saved to {output_filename}")
+
+
+def profile_file(file):
+    # reads the file once for its modality, ROI labels and contour geometry
+    try:
+        ds = pydicom.read_file(file, force=True)
+        modality = str(ds.get('Modality', ''))
+        roi_labels = [str(roi.ROIName) for roi in ds.get('StructureSetROISequence', [])]
+        rois = analyse_rtstruct(file, ds)
+    except Exception as e:
+        return {"file": file, "error": str(e)}
+
+    for roi in rois:
+        del roi["file"]
+
+    return {"file": file, "modality": modality, "roi_labels": roi_labels, "rois": rois}
+
+
+def profile_chunk(files):
+    return [profile_file(file) for file in files]
+
+
+def write_profiles(finished_chunks, output_file):
+    for finished_chunk in finished_chunks:
+        for profile in finished_chunk.result():
+            output_file.write(json.dumps(profile) + "\n")
+    output_file.flush()
+
+
+def scan_folder(rtss_folder, output_filename, jobs, chunk_size):
+    # walked lazily, so the listing of a large archive is never held in memory
+    file_iterator = sop_classifier.find_files(rtss_folder)
+    pending_chunks = set()
+
+    with ProcessPoolExecutor(max_workers=jobs) as pool, open(output_filename, 'w') as output_file:
+        while True:
+            files = list(itertools.islice(file_iterator, chunk_size))
+            if not files:
+                break
+            pending_chunks.add(pool.submit(profile_chunk, files))
+
+            # only a couple of chunks per process are in flight at once, keeping memory bounded
+            if len(pending_chunks) >= 2 * jobs:
+                finished_chunks, pending_chunks = wait(pending_chunks, return_when=FIRST_COMPLETED)
+                write_profiles(finished_chunks, output_file)
+
+        finished_chunks, pending_chunks = wait(pending_chunks)
+        write_profiles(finished_chunks, output_file)
+
+    print(f"Scan results saved to {output_filename}")
+
+
+def cli_args():
+    parser = argparse.ArgumentParser(description="A program to inspect and analyse DICOM RTSTRUCT files.")
+
+    parser.add_argument("-a", "--analyse",
+                        help="write per-ROI contour geometry for every RTSTRUCT in the folder to a CSV file",
+                        default=False, action='store_true')
+
+    parser.add_argument("-d", "--directory",
+                        help="scan this folder without any dialogs, writing one JSON line per file")
+
+    parser.add_argument("-o", "--output",
+                        help="JSON Lines output file for --directory (default: dated file in the current folder)")
+
+    parser.add_argument("-j", "--jobs",
+                        help="number of processes used by --directory", default=os.cpu_count(), type=int)
+
+    parser.add_argument("-c", "--chunk_size",
+                        help="number of files handed to a process at a time by --directory", default=64, type=int)
+
+    args_int = parser.parse_args()
+    return args_int
+
+
 def main():
+    if args.directory:
+        date = datetime.datetime.today().strftime('%Y-%m-%d_%H%M%S')
+        output_filename = args.output or f"{date}_rtss_scan.jsonl"
+        scan_folder(args.directory, output_filename, args.jobs, args.chunk_size)
+        return
+
     rtss_folder = pathlib.Path(askdirectory())
 
+    if args.analyse:
+        analyse_folder(rtss_folder)
+        return
+
     files = find_file(rtss_folder)
     for file in files:
         label_list, modality = get_roi_labels(file)
@@ -73,4 +274,5 @@ def main():
 
 
 if __name__ == "__main__":
+    args = cli_args()
     main()
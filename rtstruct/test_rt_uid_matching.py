@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+# Author: Jason Lunn, The Institute of Cancer Research, UK
+
+import sys
+import types
+import pathlib
+
+import numpy as np
+import pydicom
+import pytest
+from pydicom.dataset import Dataset, FileDataset, FileMetaDataset
+from pydicom.sequence import Sequence
+from pydicom.uid import ImplicitVRLittleEndian, ExplicitVRLittleEndian, ExplicitVRBigEndian
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+# keystore needs pykeepass, which plays no part in rewriting UIDs
+if "keystore.keystore" not in sys.modules:
+    try:
+        import keystore.keystore
+    except ImportError:
+        sys.modules["keystore.keystore"] = types.ModuleType("keystore.keystore")
+
+import rt_uid_matching
+
+NEW_STUDY_UID = "1.2.826.0.1.3680043.8.498.1234567890"
+NEW_SERIES_UID = "1.2.826.0.1.3680043.8.498.987654321"
+
+
+def write_rtstruct(file_path, transfer_syntax, undefined_length):
+    file_meta = FileMetaDataset()
+    file_meta.TransferSyntaxUID = transfer_syntax
+    file_meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.481.3"
+    file_meta.MediaStorageSOPInstanceUID = "1.2.3"
+
+    dataset = FileDataset(str(file_path), {}, file_meta=file_meta, preamble=b"\0" * 128)
+    dataset.is_implicit_VR = transfer_syntax == ImplicitVRLittleEndian
+    dataset.is_little_endian = transfer_syntax != ExplicitVRBigEndian
+    dataset.SpecificCharacterSet = "ISO_IR 100"
+    dataset.PatientName = "PATIENT"
+    dataset.SOPInstanceUID = "1.2.3"
+
+    series_item = Dataset()
+    series_item.SeriesInstanceUID = "1.1"
+    study_item = Dataset()
+    study_item.ReferencedSOPClassUID = "1.2.840.10008.3.1.2.3.1"
+    study_item.ReferencedSOPInstanceUID = "1.0"
+    study_item.RTReferencedSeriesSequence = Sequence([series_item])
+    frame_item = Dataset()
+    frame_item.FrameOfReferenceUID = "9.9"
+    frame_item.RTReferencedStudySequence = Sequence([study_item])
+    dataset.ReferencedFrameOfReferenceSequence = Sequence([frame_item])
+
+    contour_item = Dataset()
+    contour_item.ReferencedROINumber = 1
+    contour_item.ContourData = list(np.arange(300.0))
+    dataset.ROIContourSequence = Sequence([contour_item])
+
+    if undefined_length:
+        for sequence_tag in (0x30060010, 0x30060039):
+            dataset[sequence_tag].is_undefined_length = True
+        for item in (frame_item, study_item, series_item, contour_item):
+            item.is_undefined_length_sequence_item = True
+
+    dataset.save_as(str(file_path), write_like_original=True)
+
+
+@pytest.mark.parametrize("undefined_length", [False, True])
+@pytest.mark.parametrize("transfer_syntax", [ImplicitVRLittleEndian, ExplicitVRLittleEndian, ExplicitVRBigEndian])
+def test_rewrite_splices_referenced_uids(tmp_path, transfer_syntax, undefined_length):
+    file_path = tmp_path / "rtstruct.dcm"
+    write_rtstruct(file_path, transfer_syntax, undefined_length)
+    original = pydicom.read_file(str(file_path))
+
+    with open(file_path, 'rb') as local_file:
+        # the in place edit has to handle the file, not hand it to the full rewrite
+        assert rt_uid_matching.find_frame_of_reference_element(local_file) is not None
+
+    assert rt_uid_matching.rewrite_local_file_uids(str(file_path), NEW_STUDY_UID, NEW_SERIES_UID)
+
+    rewritten = pydicom.read_file(str(file_path))
+    study_item = rewritten.ReferencedFrameOfReferenceSequence[0].RTReferencedStudySequence[0]
+    assert study_item.ReferencedSOPInstanceUID == NEW_STUDY_UID
+    assert study_item.RTReferencedSeriesSequence[0].SeriesInstanceUID == NEW_SERIES_UID
+    assert rewritten.ReferencedFrameOfReferenceSequence[0].FrameOfReferenceUID == "9.9"
+    assert rewritten.ROIContourSequence[0].ContourData == original.ROIContourSequence[0].ContourData
+    assert rewritten.PatientName == "PATIENT"
+
+    # nothing left to change the second time round
+    assert not rt_uid_matching.rewrite_local_file_uids(str(file_path), NEW_STUDY_UID, NEW_SERIES_UID)
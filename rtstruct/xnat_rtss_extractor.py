@@ -2,16 +2,20 @@
 
 # Author: Jason Lunn, The Institute of Cancer Research, UK
 
-import re
 import csv
-import subprocess
+import argparse
 import requests
 import datetime
+from concurrent.futures import ThreadPoolExecutor
 from tkinter.filedialog import askopenfilename
 from urllib3.exceptions import InsecureRequestWarning
 
+import anonymiser.anonymiser as anonymiser
+
 requests.packages.urllib3.disable_warnings(category=InsecureRequestWarning)
 
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
 
 def get_login_details():
     domain = input(f"Enter XNAT Domain: ")
@@ -29,7 +33,7 @@ def read_input_file():
     return wanted_list
 
 
-def anon_insertion(anon_name, project_id, script_path):
+def anon_insertion(anon_name, project_id):
     # (0010,0010) DICOM tag
     new_name = f"\n(0010,0010) := \"{anon_name}\" // Anonymised Patient Name\n"
     # (0010,0020) DICOM tag
@@ -44,106 +48,180 @@ def anon_insertion(anon_name, project_id, script_path):
                        f"AA:True\", session] // Patient Comments\n"
     # "(0008,0020), substring[(0008,0030), 0, 6], (0008,1090) // Patient Comments"
 
-    with open(script_path, 'r') as standard_script:
-        content = standard_script.read()
+    # appended to the anonymisation profile by the anonymisation service, once per subject
+    script_additions = new_name + project_line + session + patient_comments
+    # script_additions += new_id + study_desc
 
-    custom_script_path = "customised_script.das"
-    with open(custom_script_path, 'w') as custom_script:
-        custom_script.write(content)
-        custom_script.write(new_name)
-        # custom_script.write(new_id)
-        custom_script.write(project_line)
-        custom_script.write(session)
-        # custom_script.write(study_desc)
-        custom_script.write(patient_comments)
+    return script_additions
 
-    return custom_script_path
 
+def anonymisation(anonymisation_service, file_path, anon_id, project_id):
+    result = anonymisation_service.anonymise(file_path, file_path, {"anon_name": anon_id, "project_id": project_id})
 
-def anonymisation(script_path, file_path, anon_id, project_id):
-    custom_script_path = anon_insertion(anon_id, project_id, script_path)
+    if not result.ok:
+        print("Error in anonymisation;", result.error)
+        raise SystemExit
 
-    jar_path = "dicom-edit.jar"
-    run_jar = f"java -jar {jar_path}"
 
-    command = f"{run_jar} -s {custom_script_path} -i {file_path} -o {file_path}"
-    anon = subprocess.Popen(command.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    jar_error = anon.stderr.read().decode('utf-8')
+def create_xnat_session(user, pw, connections):
+    xnat_session = requests.Session()
+    xnat_session.auth = (user, pw)
+    xnat_session.verify = False
 
-    if re.search(r"\b" + re.escape('error') + r"\b", jar_error, flags=re.IGNORECASE):
-        print("Error in anonymisation;", jar_error)
-        raise SystemExit
+    # keep-alive connections shared by all of the worker threads
+    adapter = requests.adapters.HTTPAdapter(pool_connections=connections, pool_maxsize=connections)
+    xnat_session.mount("https://", adapter)
+    xnat_session.mount("http://", adapter)
 
+    return xnat_session
 
-def extraction(domain, user, pw, project, input_list):
-    extraction_path = "extracted/"
-    script_path = askopenfilename(title="Choose an anonymisation profile")
 
-    found_counter = 0
-    not_found_list = []
+def xnat_result_list(xnat_session, uri):
+    request_object = xnat_session.get(uri)
+    request_json = request_object.json()
 
-    for patient in range(len(input_list)):
+    return request_json['ResultSet']['Result']
 
-        name = input_list[patient][0]
-        experiment = input_list[patient][1][:15]
-        anon_id = input_list[patient][2]
 
+def unique_file_path(extraction_path, anon_id, now):
+    # files for the same patient downloaded within the same second would otherwise overwrite each other
+    file_path = extraction_path + anon_id + "_" + now + ".dcm"
+    suffix = 1
+    while True:
         try:
-            experiments_request = requests.get(f'{domain}/data/projects/{project}/subjects/{name}'
-                                               f'/experiments', auth=(user, pw), verify=False)
-            experiment_json = experiments_request.json()
-            experiment_list = []
-            [experiment_list.append(exp['label']) for exp in experiment_json['ResultSet']['Result']]
+            with open(file_path, 'xb'):
+                return file_path
+        except FileExistsError:
+            file_path = extraction_path + anon_id + "_" + now + f"_{suffix}.dcm"
+            suffix += 1
+
+
+def download_file(xnat_session, uri, file_path):
+    with xnat_session.get(uri, stream=True) as file_download:
+        with open(file_path, 'wb') as save_file:
+            for chunk in file_download.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                save_file.write(chunk)
+
+
+def extract_scan(xnat_session, scan_uri, extraction_path, anonymisation_service, anon_id, project):
+    file_json = xnat_result_list(xnat_session, f'{scan_uri}/files')
+    file_list = []
+    [file_list.append(file['Name']) for file in file_json]
+
+    matching = [f for f in file_list if "RTSTRUCT" in f]
+
+    found_counter = 0
+    for file in matching:
+        now = str(datetime.datetime.now())[:19]
+        now = now.replace(":", "_")
+        now = now.replace(" ", "_")
+
+        file_path = unique_file_path(extraction_path, anon_id, now)
 
-            match_exp = [f for f in experiment_list if experiment in f]
+        download_file(xnat_session, f'{scan_uri}/files/{file}', file_path)
+        anonymisation(anonymisation_service, file_path, anon_id, project)
 
-            if match_exp:
-                scans_request = requests.get(f'{domain}/data/projects/{project}/subjects/{name}'
-                                             f'/experiments/{match_exp[0]}/scans', auth=(user, pw), verify=False)
-                scan_json = scans_request.json()
-                scan_list = []
-                [scan_list.append(scan['ID']) for scan in scan_json['ResultSet']['Result']]
+        found_counter += 1
 
-                for scan in scan_list:
-                    files_request = requests.get(f'{domain}/data/projects/{project}/subjects/{name}'
-                                                 f'/experiments/{experiment}/scans/{scan}/files', auth=(user, pw), verify=False)
-                    file_json = files_request.json()
-                    file_list = []
-                    [file_list.append(file['Name']) for file in file_json['ResultSet']['Result']]
+    return found_counter
 
-                    matching = [f for f in file_list if "RTSTRUCT" in f]
 
-                    for file in matching:
-                        file_download = requests.get(f'{domain}/data/projects/{project}/subjects/{name}'
-                                                     f'/experiments/{experiment}/scans/{scan}/files/{file}',
-                                                     auth=(user, pw), verify=False)
+def extract_patient(xnat_session, scan_pool, domain, project, patient_row, extraction_path, anonymisation_service):
+    name = patient_row[0]
+    experiment = patient_row[1][:15]
+    anon_id = patient_row[2]
 
-                        now = str(datetime.datetime.now())[:19]
-                        now = now.replace(":", "_")
-                        now = now.replace(" ", "_")
+    try:
+        experiment_json = xnat_result_list(xnat_session, f'{domain}/data/projects/{project}/subjects/{name}'
+                                                         f'/experiments')
+        experiment_list = []
+        [experiment_list.append(exp['label']) for exp in experiment_json]
 
-                        file_path = extraction_path + anon_id + "_" + now + ".dcm"
+        match_exp = [f for f in experiment_list if experiment in f]
 
-                        with open(file_path, 'wb') as save_file:
-                            save_file.write(file_download.content)
-                        anonymisation(script_path, file_path, anon_id, project)
+        if match_exp:
+            scan_json = xnat_result_list(xnat_session, f'{domain}/data/projects/{project}/subjects/{name}'
+                                                       f'/experiments/{match_exp[0]}/scans')
+            scan_list = []
+            [scan_list.append(scan['ID']) for scan in scan_json]
 
-                        found_counter += 1
+            scan_jobs = [scan_pool.submit(extract_scan, xnat_session,
+                                          f'{domain}/data/projects/{project}/subjects/{name}'
+                                          f'/experiments/{experiment}/scans/{scan}',
+                                          extraction_path, anonymisation_service, anon_id, project)
+                         for scan in scan_list]
 
-            else:
-                print(f"Patient {name} found, but session {experiment} not found")
-        except:
-            not_found_list.append(name)
+            # every scan is waited on before reporting, so a failure in one doesn't hide files found in the rest
+            found_counts = []
+            scan_failed = False
+            for scan_job in scan_jobs:
+                try:
+                    found_counts.append(scan_job.result())
+                except BaseException:
+                    scan_failed = True
+
+            if scan_failed:
+                return sum(found_counts), name
+            return sum(found_counts), None
+
+        else:
+            print(f"Patient {name} found, but session {experiment} not found")
+    except BaseException:
+        return 0, name
+
+    return 0, None
+
+
+def extraction(domain, user, pw, project, input_list, connections=8, anonymisation_workers=2):
+    extraction_path = "extracted/"
+    script_path = askopenfilename(title="Choose an anonymisation profile")
+
+    found_counter = 0
+    not_found_list = []
+
+    # the connections are split between the two pools, so together they never make more than that many requests
+    # separate pools, as patient threads wait on their scans and would starve a shared pool
+    patient_workers = max(1, connections // 2)
+    scan_workers = max(1, connections - patient_workers)
+
+    with create_xnat_session(user, pw, connections) as xnat_session, \
+            anonymiser.AnonymisationService(script_path, anon_insertion,
+                                            workers=anonymisation_workers) as anonymisation_service, \
+            ThreadPoolExecutor(max_workers=patient_workers) as patient_pool, \
+            ThreadPoolExecutor(max_workers=scan_workers) as scan_pool:
+        patient_jobs = [patient_pool.submit(extract_patient, xnat_session, scan_pool, domain, project, patient_row,
+                                            extraction_path, anonymisation_service)
+                        for patient_row in input_list]
+
+        # collected in input order so the not found list reads the same as before
+        for patient_job in patient_jobs:
+            patient_found, not_found_name = patient_job.result()
+            found_counter += patient_found
+            if not_found_name is not None:
+                not_found_list.append(not_found_name)
 
     return found_counter, not_found_list
 
 
+def cli_args():
+    parser = argparse.ArgumentParser(
+        description="A program to download and anonymise the RTSTRUCT files of a list of patients from XNAT.")
+
+    parser.add_argument("-c", "--connections",
+                        help="maximum number of concurrent requests to XNAT", default=8, type=int)
+    parser.add_argument("-w", "--workers",
+                        help="number of DicomEdit JVMs anonymising files at once", default=2, type=int)
+
+    args_int = parser.parse_args()
+    return args_int
+
+
 def main():
     project = input(f"Enter Project ID: ")
     # project = "TEST_UPLOAD"
     dom, u, pw = get_login_details()
     wanted_list = read_input_file()
-    found_count, non_list = extraction(dom, u, pw, project, wanted_list)
+    found_count, non_list = extraction(dom, u, pw, project, wanted_list, args.connections, args.workers)
 
     print(f"Found {found_count} RTSTRUCT files for {len(wanted_list)} patients")
 
@@ -153,4 +231,5 @@ def main():
 
 
 if __name__ == "__main__":
+    args = cli_args()
     main()
@@ -2,7 +2,16 @@
 
 # Author: Jason Lunn, The Institute of Cancer Research, UK
 
+import io
+import os
+import json
+import time
+import shutil
+import struct
+import sqlite3
+import threading
 import pydicom
+import numpy as np
 import getpass
 import requests
 import tempfile
@@ -10,11 +19,107 @@ from pathlib import Path
 import zipfile
 import datetime
 import csv
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
 
 
-def read_seg(directory_path):
+def read_seg_lazily(directory_path):
     files = list(Path(directory_path).rglob('*.dcm'))
-    seg = pydicom.read_file(files[0], force=True)
+
+    return read_seg_file_lazily(files[0])
+
+
+def read_seg_file_lazily(file_path):
+    # first pass parses geometry and functional groups only, leaving the file positioned at the Pixel Data
+    with open(file_path, 'rb') as seg_file:
+        seg = pydicom.read_file(seg_file, force=True, stop_before_pixels=True)
+        pixel_data_offset = seg_file.tell()
+
+    # second pass maps the Pixel Data value in place, so frames are only paged in as they are counted
+    pixel_buffer = map_pixel_data(file_path, seg, pixel_data_offset)
+    if pixel_buffer is None:
+        seg = pydicom.read_file(file_path, force=True)
+
+    return seg, pixel_buffer
+
+
+def map_pixel_data(file_path, seg, element_offset):
+    # only native little endian Pixel Data can be mapped directly, anything else is read in full instead
+    if not seg.is_little_endian:
+        return None
+
+    with open(file_path, 'rb') as seg_file:
+        seg_file.seek(element_offset)
+        element_header = seg_file.read(12)
+
+    if len(element_header) < 8 or struct.unpack('<HH', element_header[:4]) != (0x7fe0, 0x0010):
+        return None
+
+    if seg.is_implicit_VR:
+        value_length = struct.unpack('<I', element_header[4:8])[0]
+        value_offset = element_offset + 8
+    elif element_header[4:6] in (b'OB', b'OW', b'UN'):
+        value_length = struct.unpack('<I', element_header[8:12])[0]
+        value_offset = element_offset + 12
+    else:
+        value_length = struct.unpack('<H', element_header[6:8])[0]
+        value_offset = element_offset + 8
+
+    # undefined length means encapsulated (compressed) Pixel Data
+    if value_length == 0xFFFFFFFF or value_length == 0:
+        return None
+
+    pixel_buffer = np.memmap(file_path, dtype=np.uint8, mode='r', offset=value_offset, shape=(value_length,))
+
+    return pixel_buffer
+
+
+def read_zipped_seg(zipped_data):
+    # parse the first .dcm member straight out of the downloaded zip, without extracting it to disk
+    with zipfile.ZipFile(zipped_data, 'r') as zip_file:
+        seg_member = next(name for name in zip_file.namelist() if name.endswith('.dcm'))
+        with zip_file.open(seg_member) as seg_file:
+            seg = pydicom.read_file(seg_file, force=True)
+
+    return seg
+
+
+def read_zipped_seg_bytes(zipped_data):
+    with zipfile.ZipFile(zipped_data, 'r') as zip_file:
+        seg_member = next(name for name in zip_file.namelist() if name.endswith('.dcm'))
+        seg_bytes = zip_file.read(seg_member)
+
+    return seg_bytes
+
+
+def extract_zipped_seg(zipped_data):
+    # copies the first .dcm member of a download spilled to disk out to a file of its own, so it can be mapped
+    with zipfile.ZipFile(zipped_data, 'r') as zip_file:
+        seg_member = next(name for name in zip_file.namelist() if name.endswith('.dcm'))
+        with zip_file.open(seg_member) as member_file, \
+                tempfile.NamedTemporaryFile(dir="data/", prefix="seg_extract_", suffix=".dcm",
+                                            delete=False) as seg_file:
+            shutil.copyfileobj(member_file, seg_file, DOWNLOAD_CHUNK_SIZE)
+
+    return seg_file.name
+
+
+def read_downloaded_seg(zipped_data):
+    # downloads still held in memory are passed on as bytes, larger ones as the path of the extracted SEG
+    if isinstance(zipped_data, io.BytesIO):
+        return read_zipped_seg_bytes(zipped_data)
+
+    return extract_zipped_seg(zipped_data)
+
+
+def remove_downloaded_seg(seg_source):
+    if isinstance(seg_source, str):
+        os.remove(seg_source)
+
+
+def read_seg_bytes(seg_bytes):
+    seg = pydicom.read_file(io.BytesIO(seg_bytes), force=True)
 
     return seg
 
@@ -60,50 +165,104 @@ def get_voxel_volume(seg):
     return voxel_volume, voxel_dimensions
 
 
-def get_segment_pixel_count(seg, start_byte, end_byte):
-    # Pixel Data
-    tag_7fe0_0010 = seg['7fe00010']
+# number of set bits in every possible byte value, used to popcount whole frames with one table lookup
+# kept as uint8 so the lookup result is no larger than the batch it was taken from
+BYTE_POPCOUNT_TABLE = np.unpackbits(np.arange(256, dtype=np.uint8)[:, np.newaxis], axis=1).sum(axis=1).astype(np.uint8)
+# frames counted per batch, a multiple of 8 so every batch starts on a byte boundary even for bit-packed frames
+FRAMES_PER_BATCH = 256
 
-    frame_array = bytearray(tag_7fe0_0010.value)[start_byte:end_byte]
-    bytes_as_bits = ''.join(format(byte, '08b') for byte in frame_array)
 
-    zeros = bytes_as_bits.count("0")
-    ones = bytes_as_bits.count("1")
-    # print("0's", zeros)
-    # print("1's", ones)
-    # print(len(bytes_as_bits) - zeros, '\n')
+def get_frame_pixel_counts(seg, pixel_buffer=None):
+    if pixel_buffer is None:
+        # Pixel Data, viewed in place rather than copied
+        tag_7fe0_0010 = seg['7fe00010']
+        pixel_buffer = np.frombuffer(tag_7fe0_0010.value, dtype=np.uint8)
 
-    return int(ones)
+    num_of_frames = get_number_of_frames(seg)
+    bytes_per_frame = get_frame_size(seg)
+    # (0028, 0010) Rows, (0028, 0011) Columns, (0028, 0101) Bits Stored
+    bits_per_frame = seg['00280010'].value * seg['00280011'].value * seg['00280101'].value
 
+    pixel_counts = np.empty(num_of_frames, dtype=np.int64)
 
-def calculate_segment_volume(number_of_pixels, voxel_volume):
-    segment_volume = float(number_of_pixels) * float(voxel_volume)
-    return segment_volume
+    # count in fixed-size batches of frames, so a memory-mapped buffer is never fully resident at once
+    for first_frame in range(0, num_of_frames, FRAMES_PER_BATCH):
+        batch_frames = min(FRAMES_PER_BATCH, num_of_frames - first_frame)
+        start_byte = first_frame * bits_per_frame // 8
+        end_byte = -(-(first_frame + batch_frames) * bits_per_frame // 8)
+        batch_buffer = pixel_buffer[start_byte:end_byte]
 
+        if bits_per_frame % 8 == 0:
+            # frames start on byte boundaries, so count each frame's bytes directly
+            frames = batch_buffer.reshape(batch_frames, bytes_per_frame)
+            batch_counts = BYTE_POPCOUNT_TABLE[frames].sum(axis=1, dtype=np.int64)
+        else:
+            # frames are packed across byte boundaries, so split the unpacked bit stream instead
+            bits = np.unpackbits(batch_buffer, bitorder='little')[:batch_frames * bits_per_frame]
+            batch_counts = bits.reshape(batch_frames, bits_per_frame).sum(axis=1, dtype=np.int64)
 
-def find_volume(seg_data):
-    segment_volumes = {}
+        pixel_counts[first_frame:first_frame + batch_frames] = batch_counts
 
-    voxel_volume, voxel_dimensions = get_voxel_volume(seg_data)
+    return pixel_counts
 
-    num_of_frames = get_number_of_frames(seg_data)
-    bytes_per_frame = get_frame_size(seg_data)
 
-    for frame in range(1, num_of_frames + 1):
-        segment_end_byte = frame * bytes_per_frame
-        segment_start_byte = segment_end_byte - bytes_per_frame
+def find_volume(seg_data, pixel_buffer=None):
+    voxel_volume, voxel_dimensions = get_voxel_volume(seg_data)
 
-        pixel_count = get_segment_pixel_count(seg_data, segment_start_byte, segment_end_byte)
-        segment_volume = calculate_segment_volume(pixel_count, voxel_volume)
-        segment_volumes[frame] = segment_volume
-        # exit()
+    pixel_counts = get_frame_pixel_counts(seg_data, pixel_buffer)
+    frame_volumes = pixel_counts * float(voxel_volume)
 
-    total_volume = sum(segment_volumes.values())
+    segment_volumes = dict(enumerate(frame_volumes.tolist(), start=1))
+    total_volume = float(frame_volumes.sum())
     # print(f"{total_segment_volume} mm^3")
 
     return segment_volumes, total_volume, voxel_dimensions
 
 
+def get_frame_segment_numbers(seg):
+    # (5200, 9230) Per-Frame Functional Groups Sequence
+    tag_5200_9230 = seg['52009230'].value
+
+    # (0062, 000A) Segment Identification Sequence -> (0062, 000B) Referenced Segment Number
+    segment_numbers = [int(frame_group['0062000a'][0]['0062000b'].value) for frame_group in tag_5200_9230]
+
+    return np.array(segment_numbers, dtype=np.intp)
+
+
+def get_segment_labels(seg):
+    segment_labels = {}
+
+    # (0062, 0002) Segment Sequence
+    if '00620002' in seg:
+        for segment in seg['00620002'].value:
+            # (0062, 0004) Segment Number, (0062, 0005) Segment Label
+            segment_label = segment['00620005'].value if '00620005' in segment else ""
+            segment_labels[int(segment['00620004'].value)] = str(segment_label)
+
+    return segment_labels
+
+
+def find_segment_volumes(seg_data, pixel_buffer=None):
+    voxel_volume, voxel_dimensions = get_voxel_volume(seg_data)
+
+    pixel_counts = get_frame_pixel_counts(seg_data, pixel_buffer)
+    frame_segment_numbers = get_frame_segment_numbers(seg_data)
+    segment_labels = get_segment_labels(seg_data)
+
+    # sum the per-frame counts of every segment in one pass, indexed by segment number
+    segment_pixel_counts = np.bincount(frame_segment_numbers, weights=pixel_counts,
+                                       minlength=max(segment_labels, default=0) + 1)
+
+    segment_volumes = {}
+    for segment_number in sorted(set(segment_labels) | set(frame_segment_numbers.tolist())):
+        segment_volume = float(segment_pixel_counts[segment_number]) * float(voxel_volume)
+        segment_volumes[segment_number] = (segment_labels.get(segment_number, ""), segment_volume)
+
+    total_volume = float(pixel_counts.sum()) * float(voxel_volume)
+
+    return segment_volumes, total_volume, voxel_dimensions
+
+
 def get_login_details():
 
     domain = input(f"Enter XNAT Domain: ")
@@ -113,7 +272,35 @@ def get_login_details():
     return domain, username, password
 
 
-def get_xnat_seg_list(session, domain, project_id):
+# assessor types holding ROI Collections (SEG, RTSTRUCT and AIM), and the listing columns needed downstream
+ROI_ASSESSOR_XSI_TYPES = ['icr:roiCollectionData']
+ASSESSOR_LISTING_COLUMNS = "ID,label,xsiType,project,session_ID,session_label"
+
+
+def get_xnat_seg_list_bulk(session, domain, project_id):
+    # one project-level listing per assessor type, returns None if the server cannot answer the bulk query
+    assessor_records_list = []
+
+    for xsi_type in ROI_ASSESSOR_XSI_TYPES:
+        assessor_response = session.get(f"{domain}/data/projects/{project_id}/experiments"
+                                        f"?xsiType={xsi_type}&columns={ASSESSOR_LISTING_COLUMNS}&format=json")
+        if assessor_response.status_code != 200:
+            return None
+
+        try:
+            assessor_record_list = assessor_response.json()['ResultSet']['Result']
+        except (ValueError, KeyError):
+            return None
+
+        for assessor_record in assessor_record_list:
+            if not assessor_record.get('session_ID') or not assessor_record.get('session_label'):
+                return None
+            assessor_records_list.append(assessor_record)
+
+    return assessor_records_list
+
+
+def get_xnat_seg_list_per_session(session, domain, project_id):
     experiment_list_response = session.get(f"{domain}/data/projects/{project_id}/experiments")
     experiment_list_json = experiment_list_response.json()
     experiment_list = experiment_list_json['ResultSet']['Result']
@@ -136,22 +323,42 @@ def get_xnat_seg_list(session, domain, project_id):
     return assessor_records_list
 
 
-def download_seg(xnat_session, domain, seg, temp_directory):
+def get_xnat_seg_list(session, domain, project_id):
+    assessor_records_list = get_xnat_seg_list_bulk(session, domain, project_id)
+
+    if assessor_records_list is None:
+        assessor_records_list = get_xnat_seg_list_per_session(session, domain, project_id)
+
+    return assessor_records_list
+
+
+# persistent per-assessor volume results, so unchanged SEGs are not downloaded again on the next run
+CACHE_PATH = "data/seg_volume_cache.db"
+# downloads larger than this are spilled from memory to a temporary file
+SPOOL_MAX_SIZE = 256 * 1024 ** 2
+DOWNLOAD_CHUNK_SIZE = 1024 ** 2
+
+
+def download_seg(xnat_session, domain, seg, spool_max_size=SPOOL_MAX_SIZE):
     session_id = seg['session_ID']
     assessor_id = seg['ID']
-    assessor_response = xnat_session.get(f"{domain}/data/experiments/{session_id}/assessors/{assessor_id}"
-                                         f"/resources/SEG/files?format=zip")
-    # print(assessor_response.status_code)
 
-    path_to_zipped_data = Path(f"{temp_directory}/{assessor_id}_zipped")
-    path_to_data = Path(f"{temp_directory}/{assessor_id}")
+    # hold the zip in memory, only moving it to a temporary file once it grows past spool_max_size
+    zipped_data = io.BytesIO()
+
+    with xnat_session.get(f"{domain}/data/experiments/{session_id}/assessors/{assessor_id}"
+                          f"/resources/SEG/files?format=zip", stream=True) as assessor_response:
+        # print(assessor_response.status_code)
+        for chunk in assessor_response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            if isinstance(zipped_data, io.BytesIO) and zipped_data.tell() + len(chunk) > spool_max_size:
+                spilled_data = tempfile.TemporaryFile(dir="data/", prefix="seg_download_")
+                spilled_data.write(zipped_data.getbuffer())
+                zipped_data = spilled_data
+            zipped_data.write(chunk)
 
-    with open(path_to_zipped_data, 'wb') as file:
-        file.write(assessor_response.content)
-    with zipfile.ZipFile(path_to_zipped_data, 'r') as zip_file:
-        zip_file.extractall(path_to_data)
+    zipped_data.seek(0)
 
-    return path_to_data
+    return zipped_data
 
 
 def get_subject_name(xnat_session, domain, seg):
@@ -163,31 +370,118 @@ def get_subject_name(xnat_session, domain, seg):
     return subject_name
 
 
-def get_roi_label(xnat_session, domain, seg):
+def get_assessor_details(xnat_session, domain, seg):
     session_id = seg['session_ID']
     assessor_id = seg['ID']
     assessor_response = xnat_session.get(f"{domain}/data/experiments/{session_id}/assessors/{assessor_id}?format=json")
     assessor_response_json = assessor_response.json()
-    roi_label = assessor_response_json['items'][0]['data_fields']['name']
+    assessor_item = assessor_response_json['items'][0]
+
+    roi_label = assessor_item['data_fields']['name']
+    # SOPInstanceUID of the ROI Collection and when the assessor last changed, used as the volume cache key
+    # insert_date is not a substitute, an assessor edited in place keeps it, so without last_modified nothing is cached
+    sop_instance_uid = assessor_item['data_fields'].get('UID')
+    last_modified = assessor_item.get('meta', {}).get('last_modified')
+
+    return roi_label, sop_instance_uid, last_modified
+
+
+class VolumeCache:
+    def __init__(self, database_path, refresh=False, max_age_days=30):
+        self.database_path = database_path
+        self.refresh = refresh
+        self.max_age_seconds = max_age_days * 24 * 60 * 60
+
+        # shared by the download threads of the pipelined mode, so every access is made under the lock
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.database_path, check_same_thread=False)
+
+        self.create_table()
+
+    def create_table(self):
+        with self.lock, self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS seg_volumes ("
+                                    "sop_instance_uid TEXT NOT NULL, "
+                                    "per_segment INTEGER NOT NULL, "
+                                    "last_modified TEXT NOT NULL, "
+                                    "subject_name TEXT, "
+                                    "segment_volumes TEXT, "
+                                    "total_volume REAL, "
+                                    "voxel_dimensions TEXT, "
+                                    "last_used REAL, "
+                                    "PRIMARY KEY (sop_instance_uid, per_segment))")
+
+    def lookup(self, sop_instance_uid, last_modified, per_segment):
+        # a changed last_modified timestamp invalidates the entry, and --refresh ignores every entry
+        if self.refresh or not sop_instance_uid or not last_modified:
+            return None
+
+        with self.lock, self.connection:
+            cached_row = self.connection.execute("SELECT subject_name, segment_volumes, total_volume, voxel_dimensions "
+                                                 "FROM seg_volumes WHERE sop_instance_uid = ? AND per_segment = ? "
+                                                 "AND last_modified = ?",
+                                                 (sop_instance_uid, int(per_segment), last_modified)).fetchone()
+            if cached_row is None:
+                return None
+
+            self.connection.execute("UPDATE seg_volumes SET last_used = ? "
+                                    "WHERE sop_instance_uid = ? AND per_segment = ?",
+                                    (time.time(), sop_instance_uid, int(per_segment)))
+
+        subject_name, segment_volumes, total_volume, voxel_dimensions = cached_row
+
+        segment_volume_dict = None
+        if segment_volumes is not None:
+            segment_volume_dict = {int(segment_number): tuple(segment_details)
+                                   for segment_number, segment_details in json.loads(segment_volumes).items()}
+
+        # per-frame volumes are not written to the output file, so they are not cached
+        return subject_name, (None, segment_volume_dict, total_volume, voxel_dimensions)
+
+    def store(self, sop_instance_uid, last_modified, per_segment, subject_name, volumes):
+        if not sop_instance_uid or not last_modified:
+            return
+
+        frame_volume_dict, segment_volume_dict, total_volume, voxel_dimensions = volumes
+        segment_volumes = None if segment_volume_dict is None else json.dumps(segment_volume_dict)
+
+        # voxel dimensions are kept as their output text, so cached rows match freshly calculated ones
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO seg_volumes VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                    (sop_instance_uid, int(per_segment), last_modified, subject_name,
+                                     segment_volumes, total_volume, str(voxel_dimensions), time.time()))
+
+    def evict_stale_entries(self):
+        # assessors not seen by a run within max_age_days have been deleted or moved, so drop their entries
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM seg_volumes WHERE last_used < ?",
+                                    (time.time() - self.max_age_seconds,))
+
+    def close(self):
+        self.connection.close()
+
+
+def output_fieldnames(per_segment=False):
+    fieldnames = ["subject", "session", "ROI_label", "total_volume_(mm^3)", "voxel_dimensions_(x, y, z)"]
+    if per_segment:
+        fieldnames[3:3] = ["segment_number", "segment_label", "segment_volume_(mm^3)"]
 
-    return roi_label
+    return fieldnames
 
 
-def create_output_file(project_id):
+def create_output_file(project_id, per_segment=False):
     date = datetime.datetime.today().strftime('%Y-%m-%d_%H%M%S')
     filename = f"{date}_{project_id}_SEG_Volumes.csv"
 
-    fieldnames = ["subject", "session", "ROI_label", "total_volume_(mm^3)", "voxel_dimensions_(x, y, z)"]
-
     with open(filename, 'w') as file:
         writer = csv.writer(file)
-        writer.writerow(fieldnames)
+        writer.writerow(output_fieldnames(per_segment))
 
     return filename
 
 
 def append_to_output_file(output_filename, subject_name, roi_label, seg_data, frame_volume_dictionary,
-                          seg_total_volume, voxel_dimensions):
+                          seg_total_volume, voxel_dimensions, segment_volume_dictionary=None):
     session = seg_data['session_label']
 
     output_contents = {"subject": subject_name,
@@ -196,42 +490,218 @@ def append_to_output_file(output_filename, subject_name, roi_label, seg_data, fr
                        "total_volume_(mm^3)": seg_total_volume,
                        "voxel_dimensions_(x, y, z)": voxel_dimensions}
 
+    if segment_volume_dictionary is None:
+        output_rows = [output_contents]
+    else:
+        # one row per segment, keeping the same column order as the per-segment header
+        output_rows = []
+        for segment_number, (segment_label, segment_volume) in segment_volume_dictionary.items():
+            segment_row = {"subject": subject_name,
+                           "session": session,
+                           "ROI_label": roi_label,
+                           "segment_number": segment_number,
+                           "segment_label": segment_label,
+                           "segment_volume_(mm^3)": segment_volume,
+                           "total_volume_(mm^3)": seg_total_volume,
+                           "voxel_dimensions_(x, y, z)": voxel_dimensions}
+            output_rows.append(segment_row)
+
+        # a SEG without any segments still gets its row, with the segment columns left blank
+        if not output_rows:
+            output_rows = [output_contents]
+
     with open(f"{output_filename}", 'a') as f:
-        dict_writer = csv.DictWriter(f, fieldnames=output_contents.keys())
-        dict_writer.writerow(output_contents)
+        dict_writer = csv.DictWriter(f, fieldnames=output_fieldnames(segment_volume_dictionary is not None))
+        dict_writer.writerows(output_rows)
+
+
+def calculate_volumes(seg_data, per_segment=False, pixel_buffer=None):
+    if per_segment:
+        segment_volume_dict, total_volume, voxel_dimensions = find_segment_volumes(seg_data, pixel_buffer)
+        frame_volume_dict = None
+    else:
+        frame_volume_dict, total_volume, voxel_dimensions = find_volume(seg_data, pixel_buffer)
+        segment_volume_dict = None
+
+    return frame_volume_dict, segment_volume_dict, total_volume, voxel_dimensions
+
+
+def calculate_volumes_from_source(seg_source, per_segment=False):
+    # runs in a worker process, so the SEG is passed as raw bytes or the path of the extracted file rather than a
+    # pickled dataset, and extracted files have their Pixel Data mapped rather than read
+    if isinstance(seg_source, bytes):
+        return calculate_volumes(read_seg_bytes(seg_source), per_segment)
+
+    seg_data, pixel_buffer = read_seg_file_lazily(seg_source)
+
+    return calculate_volumes(seg_data, per_segment, pixel_buffer)
+
+
+def calculate_downloaded_volumes(zipped_data, per_segment=False):
+    if isinstance(zipped_data, io.BytesIO):
+        return calculate_volumes(read_zipped_seg(zipped_data), per_segment)
+
+    seg_path = extract_zipped_seg(zipped_data)
+    try:
+        return calculate_volumes_from_source(seg_path, per_segment)
+    finally:
+        os.remove(seg_path)
+
+
+def fetch_seg(xnat_session, domain, seg, volume_cache, per_segment=False, spool_max_size=SPOOL_MAX_SIZE):
+    roi_label, sop_instance_uid, last_modified = get_assessor_details(xnat_session, domain, seg)
+    cache_key = (sop_instance_uid, last_modified)
+
+    cached_entry = volume_cache.lookup(sop_instance_uid, last_modified, per_segment)
+    if cached_entry is not None:
+        subject_name, volumes = cached_entry
+        return None, subject_name, roi_label, cache_key, volumes
 
+    with download_seg(xnat_session, domain, seg, spool_max_size) as zipped_data:
+        seg_source = read_downloaded_seg(zipped_data)
 
-def download_from_xnat():
+    subject_name = get_subject_name(xnat_session, domain, seg)
+
+    return seg_source, subject_name, roi_label, cache_key, None
+
+
+def queue_volume_calculation(downloads, volumes, volume_pool, per_segment):
+    seg, download = downloads.popleft()
+    seg_source, subject_name, roi_label, cache_key, cached_volumes = download.result()
+
+    if cached_volumes is None:
+        volume = volume_pool.submit(calculate_volumes_from_source, seg_source, per_segment)
+    else:
+        volume = Future()
+        volume.set_result(cached_volumes)
+
+    volumes.append((seg, seg_source, subject_name, roi_label, cache_key, cached_volumes is None, volume))
+
+
+def write_volume_result(volumes, output_filename, volume_cache, per_segment):
+    seg, seg_source, subject_name, roi_label, (sop_instance_uid, last_modified), newly_calculated, volume = \
+        volumes.popleft()
+    try:
+        frame_volume_dict, segment_volume_dict, total_volume, voxel_dimensions = volume.result()
+    finally:
+        remove_downloaded_seg(seg_source)
+
+    if newly_calculated:
+        volume_cache.store(sop_instance_uid, last_modified, per_segment, subject_name, volume.result())
+
+    append_to_output_file(output_filename, subject_name, roi_label,
+                          seg, frame_volume_dict, total_volume, voxel_dimensions, segment_volume_dict)
+
+
+def pipeline_from_xnat(xnat_session, domain, seg_list, output_filename, volume_cache, per_segment, connections,
+                       workers, spool_max_size=SPOOL_MAX_SIZE):
+    # SEGs are queued and written strictly in seg_list order, so the CSV matches a sequential run
+    # while at most 'connections' requests are made to XNAT at any one time
+    window_size = 2 * connections
+    downloads = deque()
+    volumes = deque()
+
+    with ThreadPoolExecutor(max_workers=connections) as download_pool, \
+            ProcessPoolExecutor(max_workers=workers) as volume_pool:
+        for seg in seg_list:
+            download = download_pool.submit(fetch_seg, xnat_session, domain, seg, volume_cache, per_segment,
+                                            spool_max_size)
+            downloads.append((seg, download))
+
+            if len(downloads) >= window_size:
+                queue_volume_calculation(downloads, volumes, volume_pool, per_segment)
+            if len(volumes) >= window_size:
+                write_volume_result(volumes, output_filename, volume_cache, per_segment)
+
+        while downloads:
+            queue_volume_calculation(downloads, volumes, volume_pool, per_segment)
+        while volumes:
+            write_volume_result(volumes, output_filename, volume_cache, per_segment)
+
+
+def download_from_xnat(per_segment=False, connections=1, workers=None, spool_max_size=SPOOL_MAX_SIZE,
+                       volume_cache=None):
     domain, username, password = get_login_details()
     project_id = input("Enter target project ID: ")
 
-    output_filename = create_output_file(project_id)
+    output_filename = create_output_file(project_id, per_segment)
+
+    if volume_cache is None:
+        volume_cache = VolumeCache(CACHE_PATH)
 
     with requests.Session() as xnat_session:
         xnat_session.auth = (username, password)
         seg_list = get_xnat_seg_list(xnat_session, domain, project_id)
 
-        for seg in seg_list:
-            with tempfile.TemporaryDirectory(dir="data/", prefix="seg_download_") as temp_location:
-                seg_location = download_seg(xnat_session, domain, seg, temp_location)
-                seg_data = read_seg(seg_location)
-                frame_volume_dict, total_volume, voxel_dimensions = find_volume(seg_data)
-                subject_name = get_subject_name(xnat_session, domain, seg)
-                roi_label = get_roi_label(xnat_session, domain, seg)
+        if connections > 1:
+            # size the connection pool to match the number of download threads sharing the session
+            adapter = requests.adapters.HTTPAdapter(pool_connections=connections, pool_maxsize=connections)
+            xnat_session.mount(domain, adapter)
+            pipeline_from_xnat(xnat_session, domain, seg_list, output_filename, volume_cache, per_segment,
+                               connections, workers, spool_max_size)
+        else:
+            for seg in seg_list:
+                roi_label, sop_instance_uid, last_modified = get_assessor_details(xnat_session, domain, seg)
+                cached_entry = volume_cache.lookup(sop_instance_uid, last_modified, per_segment)
+
+                if cached_entry is not None:
+                    subject_name, volumes = cached_entry
+                else:
+                    with download_seg(xnat_session, domain, seg, spool_max_size) as zipped_data:
+                        volumes = calculate_downloaded_volumes(zipped_data, per_segment)
+                    subject_name = get_subject_name(xnat_session, domain, seg)
+                    volume_cache.store(sop_instance_uid, last_modified, per_segment, subject_name, volumes)
+
+                frame_volume_dict, segment_volume_dict, total_volume, voxel_dimensions = volumes
                 append_to_output_file(output_filename, subject_name, roi_label,
-                                      seg, frame_volume_dict, total_volume, voxel_dimensions)
+                                      seg, frame_volume_dict, total_volume, voxel_dimensions, segment_volume_dict)
+
+    volume_cache.evict_stale_entries()
+    volume_cache.close()
 
 
 def local_file_test():
     testfile = Path("data")
-    seg = read_seg(testfile)
-    frame_volumes, total_volume, voxel_dims = find_volume(seg)
+    seg, pixel_buffer = read_seg_lazily(testfile)
+    frame_volumes, total_volume, voxel_dims = find_volume(seg, pixel_buffer)
+
+
+def cli_args():
+    parser = argparse.ArgumentParser(
+        description="A program to calculate the volumes of DICOM SEG ROI Collections stored on XNAT.")
+
+    parser.add_argument("-p", "--per_segment",
+                        help="write one row per segment instead of one per SEG", default=False, action='store_true')
+
+    parser.add_argument("-c", "--connections",
+                        help="maximum number of concurrent requests to XNAT, enables the pipelined mode when above 1",
+                        default=1, type=int)
+
+    parser.add_argument("-w", "--workers",
+                        help="number of processes used for volume calculation in the pipelined mode",
+                        default=os.cpu_count(), type=int)
+
+    parser.add_argument("-s", "--spool_size",
+                        help="size in MB above which a SEG download is spilled from memory to disk and its "
+                             "Pixel Data memory-mapped",
+                        default=SPOOL_MAX_SIZE // 1024 ** 2, type=int)
+
+    parser.add_argument("-r", "--refresh",
+                        help="ignore cached volumes and recalculate every SEG", default=False, action='store_true')
+
+    parser.add_argument("-a", "--cache_age",
+                        help="number of days an unused cache entry is kept for", default=30, type=int)
+
+    args_int = parser.parse_args()
+    return args_int
 
 
 def main():
-    download_from_xnat()
+    volume_cache = VolumeCache(CACHE_PATH, args.refresh, args.cache_age)
+    download_from_xnat(args.per_segment, args.connections, args.workers, args.spool_size * 1024 ** 2, volume_cache)
     # local_file_test()
 
 
 if __name__ == "__main__":
+    args = cli_args()
     main()
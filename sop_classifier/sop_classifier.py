@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+# Author: Jason Lunn, The Institute of Cancer Research, UK
+
+# Ultra-light SOP Class check, taking (0002,0002) Media Storage SOP Class UID from the File Meta Information straight
+# from the bytes at the start of a file, without pydicom building a dataset
+import os
+import mmap
+import struct
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+
+RT_STRUCTURE_SET_STORAGE = "1.2.840.10008.5.1.4.1.1.481.3"
+# RT Dose, RT Structure Set, RT Plan etc. all share this root
+RT_SOP_CLASS_ROOT = "1.2.840.10008.5.1.4.1.1.481"
+
+PREAMBLE_LENGTH = 128
+META_START = PREAMBLE_LENGTH + 4
+# the File Meta group is normally a couple of hundred bytes, larger groups are read again in full
+INITIAL_READ_SIZE = 1024
+MAXIMUM_READ_SIZE = 64 * 1024
+# File Meta is always explicit VR little endian, these VRs have a 2 byte reserved field and a 4 byte length
+LONG_LENGTH_VRS = {b'OB', b'OD', b'OF', b'OL', b'OV', b'OW', b'SQ', b'SV', b'UC', b'UN', b'UR', b'UT', b'UV'}
+
+# returned by find_sop_class_uid when the header stops part way through the File Meta group
+TRUNCATED = object()
+
+
+def find_sop_class_uid(header):
+    # header is any bytes-like object starting at the beginning of the file, including an mmap
+    if len(header) < META_START or header[PREAMBLE_LENGTH:META_START] != b'DICM':
+        return None
+
+    position = META_START
+    while position + 8 <= len(header):
+        group, element = struct.unpack_from('<HH', header, position)
+        if group != 0x0002:
+            return None
+
+        vr = header[position + 4:position + 6]
+        if vr in LONG_LENGTH_VRS:
+            if position + 12 > len(header):
+                return TRUNCATED
+            (length,) = struct.unpack_from('<I', header, position + 8)
+            value_start = position + 12
+        else:
+            (length,) = struct.unpack_from('<H', header, position + 6)
+            value_start = position + 8
+
+        if element == 0x0002:
+            if value_start + length > len(header):
+                return TRUNCATED
+            return header[value_start:value_start + length].rstrip(b'\x00 ').decode('ascii', errors='replace')
+
+        position = value_start + length
+
+    return TRUNCATED
+
+
+def classify_file(file_path, use_mmap=False):
+    # returns the Media Storage SOP Class UID, or None for files without a File Meta header
+    try:
+        with open(file_path, 'rb') as dicom_file:
+            if use_mmap:
+                try:
+                    with mmap.mmap(dicom_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+                        sop_class_uid = find_sop_class_uid(mapped_file)
+                except ValueError:
+                    # empty files can't be mapped
+                    return None
+            else:
+                header = dicom_file.read(INITIAL_READ_SIZE)
+                sop_class_uid = find_sop_class_uid(header)
+                if sop_class_uid is TRUNCATED and len(header) == INITIAL_READ_SIZE:
+                    dicom_file.seek(0)
+                    sop_class_uid = find_sop_class_uid(dicom_file.read(MAXIMUM_READ_SIZE))
+    except OSError:
+        return None
+
+    if sop_class_uid is TRUNCATED:
+        return None
+
+    return sop_class_uid
+
+
+def is_rtstruct(file_path, use_mmap=False):
+    return classify_file(file_path, use_mmap) == RT_STRUCTURE_SET_STORAGE
+
+
+def walk_files(folder, suffix=".dcm", recursive=True, sort=False):
+    # yields (os.DirEntry, index within its folder) for the files under folder, where the index counts every file in
+    # the folder whatever its suffix; each folder's files come before its subfolders, in listing order or sorted by
+    # name, and symlinked folders are skipped so a link can't make the walk loop
+    subfolders = []
+    with os.scandir(folder) as entries:
+        if sort:
+            entries = sorted(entries, key=lambda entry: entry.name)
+
+        file_index = 0
+        for entry in entries:
+            if entry.is_dir():
+                if not entry.is_symlink():
+                    subfolders.append(entry.path)
+                continue
+            if suffix is None or entry.name.endswith(suffix):
+                yield entry, file_index
+            file_index += 1
+
+    if recursive:
+        for subfolder in subfolders:
+            try:
+                yield from walk_files(subfolder, suffix, recursive, sort)
+            except FileNotFoundError:
+                # removed part way through the walk, as folders in the prearchive can be
+                pass
+
+
+def find_files(folder, suffix=".dcm", recursive=True, sort=False):
+    for entry, file_index in walk_files(folder, suffix, recursive, sort):
+        yield entry.path
+
+
+def classify_directory(folder, suffix=".dcm", recursive=True, use_mmap=False, workers=8, batch_size=1024):
+    # yields (file path, SOP Class UID) for every file found, reading the headers a batch at a time on a thread pool
+    file_paths = find_files(folder, suffix, recursive)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            batch = list(islice(file_paths, batch_size))
+            if not batch:
+                break
+
+            yield from zip(batch, pool.map(lambda file_path: classify_file(file_path, use_mmap), batch))
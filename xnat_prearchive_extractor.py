@@ -8,16 +8,22 @@
 
 import os
 import shutil
-import subprocess
 import datetime
 import csv
-import re
 import requests
 from tkinter.filedialog import askopenfilename
 import getpass
 import json
 from progress.bar import Bar
-import pydicom
+from concurrent.futures import ThreadPoolExecutor
+
+import anonymiser.anonymiser as anonymiser
+import sop_classifier.sop_classifier as sop_classifier
+
+
+RTSS_SOP_CLASS_UID = sop_classifier.RT_SOP_CLASS_ROOT
+# concurrent header reads and copies, both bound by the prearchive's storage rather than the CPU
+FILE_WORKERS = 8
 
 
 class FancyBar(Bar):
@@ -58,61 +64,87 @@ def read_session_file():
     return wanted_list
 
 
-def copy_data(prearchive_path, info_dict, project_id, number_of_files):
+def copy_data(prearchive_path, info_dict, project_id, number_of_files, manifest=None):
     script_path = askopenfilename(title="Choose an anonymisation profile")
 
-    with FancyBar('Extracting data from prearchive... ', max=number_of_files) as bar:
+    if manifest is None:
+        manifest, bytes_total = scan_prearchive(prearchive_path, info_dict)
+
+    session_manifests = {}
+    for entry in manifest:
+        session_manifests.setdefault(entry['anon_id'], []).append(entry)
+
+    with FancyBar('Extracting data from prearchive... ', max=number_of_files) as bar, \
+            anonymiser.AnonymisationService(script_path, anon_insertion) as anonymisation_service, \
+            ThreadPoolExecutor(max_workers=FILE_WORKERS) as copy_pool:
         for count, (anon_id, timestamp) in enumerate(info_dict.items()):
-            for root, dirs, files in os.walk(prearchive_path + timestamp):
-                for file_count, file in enumerate(files):
-                    filepath = os.path.join(root, file)
-                    correct_modality = file_modality_check(filepath)
-                    if file.endswith(".dcm") and correct_modality:
-
-                        # now = str(datetime.datetime.now())
-                        # now = now.replace(":", "_")
-                        # now = now.replace(" ", "_")
-                        new_location = f"extracted/{anon_id}_file{file_count}_{timestamp}.dcm"
-                        shutil.copy(filepath, new_location)
-                        anonymisation(script_path, new_location, anon_id, project_id)
+            session_copies = [(entry['path'], f"extracted/{anon_id}_file{entry['file_index']}_{timestamp}.dcm")
+                              for entry in session_manifests.get(anon_id, [])
+                              if entry['sop_class_uid'] is not None
+                              and RTSS_SOP_CLASS_UID in entry['sop_class_uid']]
+
+            # list() so every copy has finished, and raised any error, before anonymisation starts
+            list(copy_pool.map(lambda copy: shutil.copy(*copy), session_copies))
+
+            results = anonymisation_service.anonymise_batch(
+                (new_location, new_location, {"anon_name": anon_id, "project_id": project_id})
+                for filepath, new_location in session_copies)
+            for result in results:
+                if not result.ok:
+                    print("Error in anonymisation;", result.error)
+                    raise SystemExit
             bar.next()
 
 
-def file_modality_check(filepath):
-    rtss_uid = "1.2.840.10008.5.1.4.1.1.481"
-    file_bool = False
+def find_session_files(session_folder):
+    # yields (path, index within its folder, size) for every .dcm file under session_folder, where the index
+    # counts all of the files in the folder in listing order, as used in the extracted file names
+    if not os.path.isdir(session_folder):
+        return
+
+    for entry, file_index in sop_classifier.walk_files(session_folder):
+        yield entry.path, file_index, entry.stat().st_size
 
-    try:
-        dcm_dataset = pydicom.read_file(filepath)
-        sop_class_uid_tag = dcm_dataset['00080016'].value
-        file_bool = rtss_uid in str(sop_class_uid_tag)
-    except Exception as e:
-        pass
 
-    return file_bool
+def read_manifest_sop_class(entry):
+    entry['sop_class_uid'] = sop_classifier.classify_file(entry['path'])
+
+    return entry
+
+
+def scan_prearchive(pre_path, timestamps_dict):
+    # one pass over the matched sessions, building the manifest the copy stage works from
+    manifest = []
+    bytes_total = 0
+
+    for anon_id, folder in timestamps_dict.items():
+        for filepath, file_index, file_size in find_session_files(pre_path + folder):
+            manifest.append({"anon_id": anon_id, "timestamp": folder, "path": filepath,
+                             "file_index": file_index, "size": file_size})
+            bytes_total += file_size
+
+    with ThreadPoolExecutor(max_workers=FILE_WORKERS) as read_pool:
+        manifest = list(read_pool.map(read_manifest_sop_class, manifest))
+
+    return manifest, bytes_total
 
 
 def file_info(timestamps_dict):
     num_files = len(timestamps_dict)
     print("Total number of files found in prearchive: ", num_files)
-    bytes_total = 0
 
     with open("login_details.json", 'r') as details_file:
         details = json.load(details_file)
     pre_path = details['prearchive_path']
     # pre_path = input("Absolute path to prearchive data: ")
 
-    for folder in timestamps_dict.values():
-        for root, dirs, files in os.walk(pre_path + folder):
-            for file in files:
-                if file.endswith(".dcm"):
-                    filepath = os.path.join(root, file)
-                    bytes_total += os.stat(filepath).st_size
+    manifest, bytes_total = scan_prearchive(pre_path, timestamps_dict)
+
     print(f"Total size of data found: {bytes_total/1000**3}GB")
-    return pre_path, num_files
+    return pre_path, num_files, manifest
 
 
-def anon_insertion(anon_name, project_id, script_path):
+def anon_insertion(anon_name, project_id):
     # (0010,0010) DICOM tag
     new_name = f"\n(0010,0010) := \"{anon_name}\" // Anonymised Patient Name\n"
     # (0010,0020) DICOM tag
@@ -127,35 +159,11 @@ def anon_insertion(anon_name, project_id, script_path):
                        f"AA:True\", session] // Patient Comments\n"
     # "(0008,0020), substring[(0008,0030), 0, 6], (0008,1090) // Patient Comments"
 
-    with open(script_path, 'r') as standard_script:
-        content = standard_script.read()
-
-    custom_script_path = "customised_script.das"
-    with open(custom_script_path, 'w') as custom_script:
-        custom_script.write(content)
-        custom_script.write(new_name)
-        custom_script.write(new_id)
-        custom_script.write(project_line)
-        custom_script.write(session)
-        # custom_script.write(study_desc)
-        custom_script.write(patient_comments)
-
-    return custom_script_path
-
-
-def anonymisation(script_path, file_path, anon_id, project_id):
-    custom_script_path = anon_insertion(anon_id, project_id, script_path)
-
-    jar_path = "dicom-edit.jar"
-    run_jar = f"java -jar {jar_path}"
-
-    command = f"{run_jar} -s {custom_script_path} -i {file_path} -o {file_path}"
-    anon = subprocess.Popen(command.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    jar_error = anon.stderr.read().decode('utf-8')
+    # appended to the anonymisation profile by the anonymisation service, once per subject
+    script_additions = new_name + new_id + project_line + session + patient_comments
+    # script_additions += study_desc
 
-    if re.search(r"\b" + re.escape('error') + r"\b", jar_error, flags=re.IGNORECASE):
-        print("Error in anonymisation;", jar_error)
-        raise SystemExit
+    return script_additions
 
 
 def give_timestamp():
@@ -181,11 +189,11 @@ def main():
     matched_dict = {wanted_list[k]: prearchive_dictionary[k] for it, k in
                     enumerate(prearchive_dictionary.keys() & wanted_list.keys())}
 
-    prearchive_path, number_of_files = file_info(matched_dict)
+    prearchive_path, number_of_files, manifest = file_info(matched_dict)
 
     continue_check = input("Continue? [y/N]: ")
     if continue_check == "y":
-        copy_data(prearchive_path, matched_dict, project, number_of_files)
+        copy_data(prearchive_path, matched_dict, project, number_of_files, manifest)
 
 
 if __name__ == "__main__":
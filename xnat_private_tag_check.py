@@ -13,6 +13,7 @@ import time
 import requests
 
 from keystore import keystore
+from dicomdump import dicomdump
 
 
 class PrivateTagCheck:
@@ -59,7 +60,7 @@ class PrivateTagCheck:
                         dicom_header = self.xnat_json_request(f"services/dicomdump?src=/archive/projects/{self.project_id}/"
                                                               f"subjects/{subject_label}/experiments/{session_label}/scans/{scan_id}"
                                                               f"&format=json")
-                        has_private = self.private_tag_check(dicom_header)
+                        has_private = self.private_tag_check(dicomdump.DicomDump(dicom_header))
 
                         if has_private:
                             self.report_dict[self.project_id] = {f"{subject_label}": {f"{session_label}": {f"{scan_id}": True}}}
@@ -68,7 +69,7 @@ class PrivateTagCheck:
     
     def private_tag_check(self, dicom_header):
         for tag in dicom_header:
-            group_number = int(tag['tag1'][1:5])
+            group_number = int(tag.tag1[1:5])
             # check if group number is odd, indicates tag is not part of DICOM Standard i.e. it is a private tag
             if group_number % 2 != 0:
                 return True
@@ -10,6 +10,7 @@ import time
 import requests
 
 import keystore.keystore as keystore
+import dicomdump.dicomdump as dicomdump
 
 
 class NameDiff:
@@ -54,8 +55,9 @@ class NameDiff:
                                                               f"subjects/{subject_label}/experiments/{session_label}"
                                                               f"&format=json")
                         if dicom_header:
-                            dicom_patient_name = get_tag_data_from_xnat_header(dicom_header, "(0010,0010)")
-                            dicom_patient_id = get_tag_data_from_xnat_header(dicom_header, "(0010,0020)")
+                            dicom_header = dicomdump.DicomDump(dicom_header)
+                            dicom_patient_name, dicom_patient_id = dicom_header.values("(0010,0010)", "(0010,0020)",
+                                                                                       default="TAG EMPTY")
                             break
                         else:
                             dicom_patient_name = dicom_patient_id = "NO DATA"
@@ -79,17 +81,6 @@ class NameDiff:
                 writer.writerow(line)
 
 
-def get_tag_data_from_xnat_header(dicom_header, tag_number: str):
-    try:
-        found_tag_dict = list(filter(lambda tag_dict: tag_dict['tag1'] == tag_number, dicom_header))[0]
-    except IndexError as e:
-        found_tag_value = "TAG EMPTY"
-    else:
-        found_tag_value = found_tag_dict['value']
-
-    return found_tag_value
-
-
 def get_date_time():
     now = str(datetime.datetime.now())
     date = now[:10].replace("-", "")
@@ -17,6 +17,7 @@ import tempfile
 import zipfile
 
 import keystore.keystore as keystore
+import sop_classifier.sop_classifier as sop_classifier
 
 CWD = os.path.dirname(os.path.realpath(__file__))
 
@@ -102,9 +103,15 @@ class App:
         dicom_path = pathlib.Path(f"{self.raw_path}")
         for file_path in walk_directory(dicom_path):
             if file_path.is_file() and file_path.stem != ".DS_Store":
+                # filtered on the File Meta header first, so unwanted files are never parsed
+                sop_class_uid = sop_classifier.classify_file(file_path)
+                if sop_class_uid in uid_filter_list:
+                    pathlib.Path.unlink(file_path)
+                    continue
+
                 header = pydicom.read_file(file_path, force=True)
 
-                if header.SOPClassUID in uid_filter_list:
+                if sop_class_uid is None and header.SOPClassUID in uid_filter_list:
                     pathlib.Path.unlink(file_path)
                     continue
 